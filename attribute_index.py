@@ -0,0 +1,395 @@
+import argparse
+import math
+import os
+import time
+
+import torch
+import torch.nn.functional as F
+
+from checkpointing import atomic_save, lazy_load
+from prototype_index import kmeans, merge_topk, recall
+
+STORAGES = ('float32', 'float16', 'int8')
+
+
+def encode(x, storage):
+    """Compresses float vectors; int8 keeps one float32 scale per vector.
+
+    Returns:
+        tuple: (codes, scales or None)
+    """
+    if storage == 'int8':
+        scales = x.abs().amax(dim=1).clamp(min=1e-12) / 127.
+        codes = torch.round(x / scales.unsqueeze(1)).clamp(-127, 127).to(torch.int8)
+        return codes, scales
+    return x.to(torch.float16 if storage == 'float16' else torch.float32), None
+
+
+def decode(codes, scales):
+    x = codes.float()
+    return x * scales.unsqueeze(1) if scales is not None else x
+
+
+def image_loader(samples, model_args, batch_size, workers=0, pin_memory=False):
+    """Loader of ``infer.ImageList`` batches of a SampleIndex with the validation preprocessing.
+
+    No augmentation (and no ``lowfft``) is applied, so the vectors of an image do
+    not change between builds.
+    """
+    import torch.utils.data
+    from infer import ImageList, collate
+    from utils import preprocess_strategy
+
+    model_args.uint8_transport = True
+    model_args.flippingtest = False
+    _, _, val_transforms, val_transforms2 = preprocess_strategy(model_args.data, model_args)
+    return torch.utils.data.DataLoader(ImageList(samples, val_transforms, val_transforms2), batch_size=batch_size,
+                                       shuffle=False, num_workers=workers, pin_memory=pin_memory,
+                                       collate_fn=collate)
+
+
+@torch.no_grad()
+def extract_attributes(model, loader, device, to_float=None):
+    """Yields ``(fft_att, sample indices)`` of every batch of an ``image_loader``, on CPU.
+
+    Images that cannot be decoded are reported and skipped.
+    """
+    model.eval()
+    for input, indices, failed in loader:
+        for i, e in failed:
+            print('=> skipping {}: {}'.format(loader.dataset.samples[i][0], e))
+        if input is None:
+            continue
+        input = input.to(device, non_blocking=True)
+        if to_float is not None:
+            input = to_float(input)
+        logits, _ = model(input)
+        yield logits[3].float().cpu(), torch.as_tensor(indices, dtype=torch.int64)
+
+
+class AttributeIndex(object):
+    """Partitioned top-k search over per-image attribute vectors with compact storage.
+
+    Vectors are assigned to the closest of ``nlist`` k-means centroids (trained on a
+    sample with ``train``) and appended to that list, so inserts are incremental
+    and never re-cluster. A query scans the ``nprobe`` closest lists. Vectors are
+    stored as float16, or int8 with a per-vector scale (about a quarter of float32);
+    int8 lists are scored directly on the codes and rescaled afterwards.
+
+    Args:
+        dim (int): Attribute dimension (``--att``).
+        nlist (int): Number of lists.
+        nprobe (int): Lists scanned per query.
+        metric (string): ``'cosine'`` or ``'l2'``; higher scores are better, l2 scores
+            are negative squared distances.
+        storage (string): One of ``STORAGES``.
+    """
+
+    def __init__(self, dim, nlist=1024, nprobe=16, metric='cosine', storage='int8'):
+        if metric not in ('cosine', 'l2'):
+            raise ValueError('unknown metric {}'.format(metric))
+        if storage not in STORAGES:
+            raise ValueError('unknown storage {}'.format(storage))
+        self.dim = dim
+        self.nlist = nlist
+        self.nprobe = min(nprobe, nlist)
+        self.metric = metric
+        self.storage = storage
+        self.centroids = None
+        self._reset()
+
+    def _reset(self):
+        self._codes = [None] * self.nlist
+        self._scales = [None] * self.nlist
+        self._norms = [None] * self.nlist
+        self._ids = [None] * self.nlist
+        self._sizes = [0] * self.nlist
+
+    def __len__(self):
+        return sum(self._sizes)
+
+    def _prepare(self, x):
+        x = torch.as_tensor(x, dtype=torch.float32)
+        return F.normalize(x, p=2, dim=1) if self.metric == 'cosine' else x
+
+    def _assign(self, x):
+        if self.metric == 'cosine':
+            return x.mm(self.centroids.t()).argmax(1)
+        return torch.cdist(x, self.centroids).argmin(1)
+
+    def _probe(self, q):
+        if self.metric == 'cosine':
+            return q.mm(self.centroids.t()).topk(self.nprobe, dim=1)[1]
+        return torch.cdist(q, self.centroids).topk(self.nprobe, dim=1, largest=False)[1]
+
+    def train(self, sample, iters=20):
+        """Fits the list centroids on a representative sample of vectors.
+
+        With fewer sample vectors than lists, ``nlist`` is reduced to the sample size.
+        """
+        if len(self):
+            raise RuntimeError('the index already holds vectors, train it before adding')
+        sample = self._prepare(sample)
+        self.nlist = min(self.nlist, sample.size(0))
+        self.nprobe = min(self.nprobe, self.nlist)
+        self._reset()
+        self.centroids, _ = kmeans(sample, self.nlist, iters, spherical=(self.metric == 'cosine'))
+        return self
+
+    def _append(self, l, codes, scales, norms, ids):
+        size, n = self._sizes[l], codes.size(0)
+        if self._codes[l] is None or size + n > self._codes[l].size(0):
+            # grow geometrically so that many small inserts stay amortized O(1)
+            capacity = max(size + n, 2 * size, 64)
+            for store, new in ((self._codes, codes), (self._scales, scales), (self._norms, norms),
+                               (self._ids, ids)):
+                if new is None:
+                    continue
+                grown = new.new_empty((capacity,) + tuple(new.shape[1:]))
+                if store[l] is not None:
+                    grown[:size] = store[l][:size]
+                store[l] = grown
+        self._codes[l][size:size + n] = codes
+        if scales is not None:
+            self._scales[l][size:size + n] = scales
+        if norms is not None:
+            self._norms[l][size:size + n] = norms
+        self._ids[l][size:size + n] = ids
+        self._sizes[l] = size + n
+
+    def add(self, vectors, ids):
+        """Inserts vectors with their int64 ids (e.g. the row in the image list)."""
+        if self.centroids is None:
+            raise RuntimeError('train the index before adding vectors')
+        x = self._prepare(vectors)
+        ids = torch.as_tensor(ids, dtype=torch.long)
+        codes, scales = encode(x, self.storage)
+        # l2 needs |x|^2 of the stored (decoded) vector
+        norms = decode(codes, scales).pow(2).sum(1) if self.metric == 'l2' else None
+        assign = self._assign(x)
+        order = assign.argsort()
+        lists, counts = assign[order].unique_consecutive(return_counts=True)
+        start = 0
+        for l, n in zip(lists.tolist(), counts.tolist()):
+            sel = order[start:start + n]
+            start += n
+            self._append(l, codes[sel], None if scales is None else scales[sel],
+                         None if norms is None else norms[sel], ids[sel])
+
+    def _score(self, q, l):
+        n = self._sizes[l]
+        codes = self._codes[l][:n]
+        if self.storage == 'float32':
+            scores = q.mm(codes.t())
+        else:
+            scores = q.mm(codes.float().t())
+        if self._scales[l] is not None:
+            scores = scores * self._scales[l][:n]
+        if self.metric == 'l2':
+            scores = 2 * scores - self._norms[l][:n] - q.pow(2).sum(1, keepdim=True)
+        return scores
+
+    @torch.no_grad()
+    def search(self, queries, k=10, query_chunk=1024):
+        """Returns ``(scores, ids)``, both B x k, best first; missing results have id -1."""
+        queries = self._prepare(queries)
+        out_scores, out_ids = [], []
+        for q in queries.split(query_chunk):
+            probe = self._probe(q)
+            scores = q.new_full((q.size(0), self.nprobe, k), float('-inf'))
+            ids = probe.new_full((q.size(0), self.nprobe, k), -1)
+            order = probe.flatten().argsort()
+            rows, slots = order // self.nprobe, order % self.nprobe
+            lists, counts = probe.flatten()[order].unique_consecutive(return_counts=True)
+            start = 0
+            for l, n in zip(lists.tolist(), counts.tolist()):
+                r, j = rows[start:start + n], slots[start:start + n]
+                start += n
+                size = self._sizes[l]
+                if size == 0:
+                    continue
+                s, pos = self._score(q[r], l).topk(min(k, size), dim=1)
+                scores[r, j, :s.size(1)] = s
+                ids[r, j, :s.size(1)] = self._ids[l][:size][pos]
+            scores, ids = merge_topk(scores.flatten(1), ids.flatten(1), k)
+            out_scores.append(scores)
+            out_ids.append(ids)
+        return torch.cat(out_scores), torch.cat(out_ids)
+
+    @torch.no_grad()
+    def exact_search(self, queries, k=10):
+        """Scans every list; the reference for ``recall``."""
+        nprobe, self.nprobe = self.nprobe, self.nlist
+        try:
+            return self.search(queries, k)
+        finally:
+            self.nprobe = nprobe
+
+    def max_id(self):
+        """Largest id in the index, -1 when empty."""
+        return max([int(self._ids[l][:n].max()) for l, n in enumerate(self._sizes) if n] + [-1])
+
+    def memory_bytes(self):
+        total = 0
+        for l in range(self.nlist):
+            n = self._sizes[l]
+            for store in (self._codes, self._scales, self._norms, self._ids):
+                if store[l] is not None:
+                    total += store[l][:n].numel() * store[l].element_size()
+        return total
+
+    ''' persistence '''
+    def state_dict(self):
+        def packed(store):
+            parts = [store[l][:n] for l, n in enumerate(self._sizes) if n and store[l] is not None]
+            return torch.cat(parts) if parts else None
+        return {'dim': self.dim, 'nlist': self.nlist, 'nprobe': self.nprobe, 'metric': self.metric,
+                'storage': self.storage, 'centroids': self.centroids, 'sizes': torch.tensor(self._sizes),
+                'codes': packed(self._codes), 'scales': packed(self._scales), 'norms': packed(self._norms),
+                'ids': packed(self._ids)}
+
+    def save(self, filename):
+        atomic_save(self.state_dict(), filename)
+
+    @classmethod
+    def load(cls, filename):
+        """Loads a saved index; the vectors are memory-mapped until lists grow."""
+        state = lazy_load(filename)
+        index = cls(state['dim'], state['nlist'], state['nprobe'], state['metric'], state['storage'])
+        index.centroids = state['centroids']
+        sizes = state['sizes'].tolist()
+        start = 0
+        for l, n in enumerate(sizes):
+            if n:
+                for name, store in (('codes', index._codes), ('scales', index._scales),
+                                    ('norms', index._norms), ('ids', index._ids)):
+                    if state[name] is not None:
+                        store[l] = state[name][start:start + n]
+            start += n
+        index._sizes = sizes
+        return index
+
+
+def build(args):
+    """Extracts ``fft_att`` for a list of images with a trained model and indexes it.
+
+    The id of a vector is the line of its image in the list (after the ids of an
+    existing index).
+    """
+    from inference import load_model
+    from utils import Uint8Normalize
+
+    device = torch.device(args.device)
+    model, margs, store, _ = load_model(args.resume, device=device)
+    loader = image_loader(store.samples(args.list), margs, args.batch_size, args.workers, device.type == 'cuda')
+    to_float = Uint8Normalize()
+
+    if args.index and os.path.isfile(args.index):
+        # incremental: append the new list to an existing index
+        index = AttributeIndex.load(args.index)
+        first_id = index.max_id() + 1
+    else:
+        index, first_id = None, 0
+    pending = []
+    seen = 0
+    start = time.time()
+    for att, ids in extract_attributes(model, loader, device, to_float):
+        ids = ids + first_id
+        if index is None:
+            pending.append((att, ids))
+            if sum(a.size(0) for a, _ in pending) < args.train_size:
+                continue
+            att, ids = [torch.cat(t) for t in zip(*pending)]
+            index = AttributeIndex(att.size(1), args.nlist, args.nprobe, args.metric, args.storage)
+            index.train(att)
+            pending = []
+        index.add(att, ids)
+        seen += att.size(0)
+        print('indexed {} images ({:.1f} img/s)'.format(seen, seen / (time.time() - start)))
+    if index is None and pending:
+        # fewer images than --train-size
+        att, ids = [torch.cat(t) for t in zip(*pending)]
+        index = AttributeIndex(att.size(1), args.nlist, args.nprobe, args.metric, args.storage).train(att)
+        index.add(att, ids)
+    index.save(args.index)
+    print('saved {} vectors ({:.1f} MB) to {}'.format(len(index), index.memory_bytes() / 2 ** 20, args.index))
+
+
+def synthetic(num_vectors, dim, num_queries, seed=0):
+    """Non-negative, clustered attribute-like vectors and noisy copies of some of them as queries."""
+    g = torch.Generator().manual_seed(seed)
+    profiles = torch.rand(max(1, int(math.sqrt(num_vectors))), dim, generator=g)
+    vectors = profiles[torch.randint(profiles.size(0), (num_vectors,), generator=g)]
+    vectors = (vectors + 0.3 * torch.randn(num_vectors, dim, generator=g)).clamp(min=0)
+    queries = vectors[torch.randint(num_vectors, (num_queries,), generator=g)]
+    queries = (queries + 0.1 * torch.randn(num_queries, dim, generator=g)).clamp(min=0)
+    return vectors, queries
+
+
+def benchmark(args):
+    """Latency and recall of the partitioned index against exact search on synthetic data."""
+    vectors, queries = synthetic(args.num_vectors, args.dim, args.queries)
+    print('{:>8} {:>7} {:>9} {:>11} {:>9} {:>9}'.format('storage', 'nprobe', 'MB', 'ms/query', 'q/s', 'recall@' + str(args.k)))
+    exact_ids = None
+    for storage in args.storages.split(','):
+        nlist = args.nlist or int(math.sqrt(args.num_vectors))
+        index = AttributeIndex(args.dim, nlist, metric=args.metric, storage=storage).train(vectors[:args.train_size])
+        for start in range(0, args.num_vectors, 100000):
+            index.add(vectors[start:start + 100000], torch.arange(start, min(start + 100000, args.num_vectors)))
+        if exact_ids is None:
+            reference = AttributeIndex(args.dim, nlist, metric=args.metric, storage='float32')
+            reference.centroids = index.centroids
+            reference.add(vectors, torch.arange(args.num_vectors))
+            start = time.time()
+            _, exact_ids = reference.exact_search(queries, args.k)
+            elapsed = time.time() - start
+            print('{:>8} {:>7} {:9.1f} {:>11} {:9.0f} {:9.3f}'.format(
+                'float32', 'all', reference.memory_bytes() / 2 ** 20, '-', args.queries / elapsed, 1.0))
+        for nprobe in [int(p) for p in args.nprobe.split(',')]:
+            index.nprobe = min(nprobe, nlist)
+            index.search(queries[:8], args.k)
+            start = time.time()
+            _, ids = index.search(queries, args.k)
+            elapsed = time.time() - start
+            # single-query latency, the serving case
+            single = time.time()
+            for q in queries[:32]:
+                index.search(q.unsqueeze(0), args.k)
+            single = (time.time() - single) / 32
+            print('{:>8} {:7d} {:9.1f} {:11.2f} {:9.0f} {:9.3f}'.format(
+                storage, index.nprobe, index.memory_bytes() / 2 ** 20, single * 1e3, args.queries / elapsed,
+                recall(exact_ids, ids)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='attribute-space image retrieval index')
+    sub = parser.add_subparsers(dest='command')
+    p = sub.add_parser('build', help='extract fft_att of an image list and index it')
+    p.add_argument('--resume', required=True, help='trained checkpoint')
+    p.add_argument('--list', default='test_unseen.list', help='image list inside the dataset directory')
+    p.add_argument('--index', required=True, help='index file; an existing index is appended to')
+    p.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    p.add_argument('-b', '--batch-size', default=64, type=int)
+    p.add_argument('-j', '--workers', default=4, type=int)
+    p.add_argument('--nlist', default=1024, type=int)
+    p.add_argument('--nprobe', default=16, type=int)
+    p.add_argument('--metric', default='cosine', choices=['cosine', 'l2'])
+    p.add_argument('--storage', default='int8', choices=STORAGES)
+    p.add_argument('--train-size', default=100000, type=int, help='vectors used to fit the lists')
+    p = sub.add_parser('bench', help='latency/recall benchmark on synthetic vectors')
+    p.add_argument('--num-vectors', default=1000000, type=int)
+    p.add_argument('--dim', default=312, type=int)
+    p.add_argument('--queries', default=1000, type=int)
+    p.add_argument('-k', default=10, type=int)
+    p.add_argument('--nlist', default=None, type=int)
+    p.add_argument('--nprobe', default='4,16,64', help='comma-separated values to sweep')
+    p.add_argument('--metric', default='cosine', choices=['cosine', 'l2'])
+    p.add_argument('--storages', default='float16,int8', help='comma-separated storages to compare')
+    p.add_argument('--train-size', default=100000, type=int)
+    args = parser.parse_args()
+    if args.command == 'build':
+        build(args)
+    elif args.command == 'bench':
+        benchmark(args)
+    else:
+        parser.print_help()
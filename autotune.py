@@ -0,0 +1,126 @@
+import json
+import os
+import socket
+import time
+from functools import partial
+
+import torch
+import torch.utils.data
+
+from utils import log_print
+
+
+def _limit_threads(threads, worker_id):
+    torch.set_num_threads(threads)
+
+
+def config_key(args):
+    """Key of a tuned configuration: machine, dataset, batch size and the options that change the loader cost.
+
+    These are the augmentation preset, ``--fetch-threads``, ``--repeat-aug`` and ``--uint8-transport``.
+    """
+    return '{}-{}cpu-{}-{}-b{}-ft{}-ra{}{}'.format(socket.gethostname(), os.cpu_count(), args.data, args.aug,
+                                                   args.batch_size, args.fetch_threads, args.repeat_aug,
+                                                   '-u8' if args.uint8_transport else '')
+
+
+def load_config(path, key):
+    if not os.path.isfile(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f).get(key)
+
+
+def save_config(path, key, config):
+    configs = {}
+    if os.path.isfile(path):
+        with open(path, 'r') as f:
+            configs = json.load(f)
+    configs[key] = config
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(configs, f, indent=2, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def loader_kwargs(config):
+    """DataLoader keyword arguments for a configuration dict."""
+    kwargs = {'num_workers': config['workers']}
+    if config['workers'] > 0:
+        kwargs['prefetch_factor'] = config.get('prefetch', 2)
+        kwargs['persistent_workers'] = config.get('persistent', False)
+        if config.get('threads'):
+            kwargs['worker_init_fn'] = partial(_limit_threads, config['threads'])
+    return kwargs
+
+
+def time_loader(dataset, batch_size, sampler, config, num_batches):
+    """Estimates the epoch time of a loader configuration.
+
+    Runs ``num_batches`` batches after a warm-up batch, then starts a second epoch
+    to measure the restart cost (worker start-up unless workers are persistent).
+
+    Returns:
+        tuple: (estimated epoch seconds, seconds per batch, restart seconds)
+    """
+    loader = torch.utils.data.DataLoader(
+        dataset, batch_size=batch_size, shuffle=(sampler is None), sampler=sampler,
+        pin_memory=True, drop_last=True, collate_fn=dataset.collate, **loader_kwargs(config))
+    steps = len(loader)
+    num_batches = max(1, min(num_batches, steps - 1))
+    it = iter(loader)
+    next(it)
+    start = time.time()
+    for _ in range(num_batches):
+        next(it)
+    per_batch = (time.time() - start) / num_batches
+    del it
+
+    start = time.time()
+    next(iter(loader))
+    restart = time.time() - start
+    del loader
+    return restart + per_batch * steps, per_batch, restart
+
+
+def tune(dataset, batch_size, sampler, log, num_batches=20, max_workers=None):
+    """Picks workers, prefetch depth, persistence and per-worker threads by coordinate descent.
+
+    Each knob is tuned in turn with the others fixed at their best value so far,
+    which needs far fewer trials than the full grid.
+
+    Returns:
+        dict: The best configuration, or None if the loader yields fewer than two
+        batches (one to warm up, one to time).
+    """
+    samples = len(sampler) if sampler is not None else len(dataset)
+    if samples // batch_size < 2:
+        log_print('autotune: {} samples make fewer than 2 batches of {}, keeping the default loader settings'.format(
+            samples, batch_size), log)
+        return None
+    cpus = os.cpu_count() or 1
+    max_workers = max_workers or cpus
+    workers = sorted(set([1, 2, 4, 6, 8, 12, 16, 24, 32, max_workers]))
+    space = [
+        ('workers', [w for w in workers if w <= max_workers]),
+        ('prefetch', [2, 4, 8]),
+        ('persistent', [False, True]),
+        ('threads', [1, 2, 4]),
+    ]
+    best = {'workers': min(cpus, 4), 'prefetch': 2, 'persistent': False, 'threads': 1}
+    best_time = None
+    seen = set()
+    for name, values in space:
+        for value in values:
+            config = dict(best, **{name: value})
+            key = tuple(sorted(config.items()))
+            if key in seen or config['workers'] * config['threads'] > cpus:
+                continue
+            seen.add(key)
+            epoch_time, per_batch, restart = time_loader(dataset, batch_size, sampler, config, num_batches)
+            log_print('autotune: {} -> {:.3f}s/batch restart {:.2f}s epoch ~{:.1f}s'.format(
+                config, per_batch, restart, epoch_time), log)
+            if best_time is None or epoch_time < best_time:
+                best, best_time = config, epoch_time
+    log_print('autotune: best {} epoch ~{:.1f}s'.format(best, best_time), log)
+    return best
@@ -0,0 +1,242 @@
+import collections
+import hashlib
+import os
+import queue
+import threading
+import warnings
+
+import torch
+
+from utils import log_print
+
+
+FROZEN_FILE = 'frozen.pth'
+
+
+def snapshot(obj):
+    """Copies every tensor in a (nested) state dict to host memory."""
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, snapshot(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(v) for v in obj)
+    return obj
+
+
+def atomic_save(obj, filename):
+    tmp = filename + '.tmp'
+    torch.save(obj, tmp)
+    os.replace(tmp, filename)
+
+
+def adapt_state_dict(state_dict, model):
+    """Adds or strips the ``module.`` prefix of (Distributed)DataParallel checkpoints to match ``model``."""
+    wrapped = next(iter(model.state_dict())).startswith('module.')
+    saved = next(iter(state_dict)).startswith('module.')
+    if wrapped == saved:
+        return state_dict
+    if wrapped:
+        return type(state_dict)(('module.' + k, v) for k, v in state_dict.items())
+    return strip_module_prefix(state_dict)
+
+
+def strip_module_prefix(state_dict):
+    """Removes the ``module.`` prefix (Distributed)DataParallel adds to every key."""
+    return type(state_dict)((k[len('module.'):] if k.startswith('module.') else k, v)
+                            for k, v in state_dict.items())
+
+
+def lazy_load(filename, weights_only=True):
+    """Memory-maps a checkpoint instead of reading it into RAM.
+
+    Tensor storages stay backed by the file and pages are only read when a tensor
+    is copied to its destination. Files in the legacy (pre-zip) format cannot be
+    mapped and are loaded eagerly.
+    """
+    try:
+        return torch.load(filename, map_location='cpu', mmap=True, weights_only=weights_only)
+    except RuntimeError as e:
+        if 'zip' not in str(e) and 'mmap' not in str(e):
+            raise
+        warnings.warn('{} uses the legacy serialization format and is loaded into memory; '
+                      're-save it with torch.save to enable memory-mapped loading'.format(filename))
+        return torch.load(filename, map_location='cpu', weights_only=weights_only)
+
+
+def _summarize(keys):
+    """Groups state-dict keys by their top-level module, e.g. ``fc (2), layer4 (3)``."""
+    groups = collections.OrderedDict()
+    for k in keys:
+        prefix = k.split('.')[0]
+        groups[prefix] = groups.get(prefix, 0) + 1
+    return ', '.join('{} ({})'.format(k, n) for k, n in groups.items())
+
+
+def load_weights(model, state_dict, log=None):
+    """Copies the tensors of ``state_dict`` that ``model`` has straight into its parameters.
+
+    ``state_dict`` may be a file name, which is memory-mapped. Keys the model does
+    not have are skipped and reported, as are model keys the state dict lacks
+    (printed when no ``log`` file is given).
+
+    Returns:
+        tuple: (missing keys, unexpected keys)
+    """
+    if isinstance(state_dict, str):
+        state_dict = lazy_load(state_dict)
+    own = model.state_dict(keep_vars=True)
+    unexpected = [k for k in state_dict if k not in own]
+    missing = [k for k in own if k not in state_dict]
+    model.load_state_dict({k: v for k, v in state_dict.items() if k in own}, strict=False)
+    report = print if log is None else (lambda s: log_print(s, log))
+    if missing:
+        report('=> {} keys not in checkpoint: {}'.format(len(missing), _summarize(missing)))
+    if unexpected:
+        report('=> {} unused checkpoint keys: {}'.format(len(unexpected), _summarize(unexpected)))
+    return missing, unexpected
+
+
+def materialize(model, device='cpu', state_dict=None, init_fn=None, strict=False, log=None):
+    """Allocates a model built on the meta device and fills in its tensors.
+
+    Tensors provided by ``state_dict`` (a dict or a file name) are copied into the
+    freshly allocated storage; only the modules owning a tensor the state dict lacks
+    are initialized, by calling ``init_fn(module)``. A missing BN ``num_batches_tracked``
+    alone (legacy state dicts) is set to zero instead. Real (non-meta) buffers the model
+    was built with, such as non-persistent buffers created from data, are kept.
+
+    Returns:
+        tuple: (missing keys, unexpected keys)
+    """
+    real = dict((k, b) for k, b in model.named_buffers() if not b.is_meta)
+    model.to_empty(device=device)
+    with torch.no_grad():
+        for k, b in real.items():
+            model.get_buffer(k).copy_(b)
+    if isinstance(state_dict, str):
+        state_dict = lazy_load(state_dict)
+    own = [k for k in model.state_dict() if k not in real]
+    if state_dict:
+        if strict:
+            missing = [k for k in own if k not in state_dict]
+            unexpected = [k for k in state_dict if k not in model.state_dict()]
+            if missing or unexpected:
+                raise RuntimeError('checkpoint does not match the model, missing: {}; unexpected: {}'.format(
+                    _summarize(missing) or '-', _summarize(unexpected) or '-'))
+        missing, unexpected = load_weights(model, state_dict, log)
+        missing = [k for k in missing if k not in real]
+        # state dicts of older torch versions have no BN step counters, resetting the
+        # whole BN layer for them would discard the loaded statistics
+        with torch.no_grad():
+            for k in missing:
+                if k.endswith('.num_batches_tracked'):
+                    model.get_buffer(k).zero_()
+        missing = [k for k in missing if not k.endswith('.num_batches_tracked')]
+    else:
+        missing, unexpected = own, []
+    with torch.no_grad():
+        for name in collections.OrderedDict((k.rpartition('.')[0], None) for k in missing):
+            init_fn(model.get_submodule(name))
+    return missing, unexpected
+
+
+def load_checkpoint(filename, map_location='cpu'):
+    """Loads a checkpoint written by CheckpointManager or save_checkpoint.
+
+    Checkpoints that only hold the trainable tensors are completed with the frozen
+    weights stored next to them. With ``map_location='cpu'`` the tensors are
+    memory-mapped (see ``lazy_load``), so ``load_state_dict`` copies them from the
+    page cache straight into the parameters.
+    """
+    # our own checkpoints also carry optimizer, NumPy RNG and metric objects
+    if map_location == 'cpu':
+        checkpoint = lazy_load(filename, weights_only=False)
+    else:
+        checkpoint = torch.load(filename, map_location=map_location, weights_only=False)
+    if 'frozen' in checkpoint:
+        frozen = os.path.join(os.path.dirname(filename), checkpoint['frozen'])
+        if map_location == 'cpu':
+            frozen = lazy_load(frozen)
+        else:
+            frozen = torch.load(frozen, map_location=map_location)
+        frozen.update(checkpoint['state_dict'])
+        checkpoint['state_dict'] = frozen
+    return checkpoint
+
+
+def fingerprint(filename, chunk_size=1 << 20):
+    """Content hash of a checkpoint and of the frozen weights file next to it, if any."""
+    h = hashlib.blake2b(digest_size=16)
+    names = [filename]
+    frozen = os.path.join(os.path.dirname(filename), FROZEN_FILE)
+    if os.path.isfile(frozen):
+        names.append(frozen)
+    for name in names:
+        with open(name, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+class CheckpointManager(object):
+    """Writes checkpoints on a background thread.
+
+    ``save`` only snapshots the tensors to host memory; a writer thread serializes
+    the snapshot to ``<filename>.tmp`` and renames it into place, so an interrupted
+    write never leaves a truncated checkpoint behind.
+
+    Args:
+        frozen (set, optional): State-dict keys of frozen parameters. They are written
+            once to ``frozen.pth`` next to the first checkpoint and later checkpoints
+            only hold the remaining (trainable) tensors.
+    """
+
+    def __init__(self, frozen=None):
+        self.frozen = frozen or set()
+        self._written_frozen = set()
+        self._queue = queue.Queue(maxsize=2)
+        self._error = None
+        self._thread = threading.Thread(target=self._write, daemon=True)
+        self._thread.start()
+
+    def _write(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                return
+            try:
+                atomic_save(*item)
+            except Exception as e:
+                self._error = e
+            self._queue.task_done()
+
+    def _check(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def save(self, state, filename):
+        self._check()
+        state = dict(state)
+        state_dict = state['state_dict']
+        if self.frozen:
+            base = os.path.join(os.path.dirname(filename), FROZEN_FILE)
+            if base not in self._written_frozen:
+                self._queue.put((snapshot({k: v for k, v in state_dict.items() if k in self.frozen}), base))
+                self._written_frozen.add(base)
+            state_dict = {k: v for k, v in state_dict.items() if k not in self.frozen}
+            state['frozen'] = FROZEN_FILE
+        state['state_dict'] = state_dict
+        self._queue.put((snapshot(state), filename))
+
+    def wait(self):
+        """Blocks until all queued checkpoints are on disk."""
+        self._queue.join()
+        self._check()
+
+    def close(self):
+        self.wait()
+        self._queue.put(None)
+        self._thread.join()
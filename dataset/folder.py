@@ -9,11 +9,13 @@ import torch
 import os
 import os.path
 import sys
-import skimage.io
 import numpy as np
-import torchvision.transforms as transforms
-import cv2
 import random
+import math
+import io
+import time
+from concurrent.futures import ThreadPoolExecutor
+from torch.utils.data.dataloader import default_collate
 
 def has_file_allowed_extension(filename, extensions):
     """Checks if a file is an allowed extension.
@@ -41,16 +43,80 @@ def is_image_file(filename):
     return has_file_allowed_extension(filename, IMG_EXTENSIONS)
 
 
+class SampleIndex(object):
+    """A packed, read-only list of (sample path, class_index) tuples.
+
+    Relative paths live in a single uint8 buffer addressed by int64 offsets and
+    labels in an int32 array. Forked DataLoader workers therefore share the
+    index without refcount writes dirtying its pages.
+
+    Args:
+        root (string): Root directory prepended to every relative path.
+        paths (ndarray): uint8 buffer with the concatenated relative paths.
+        offsets (ndarray): int64 array of ``len + 1`` boundaries into ``paths``.
+        labels (ndarray): int32 class index of every sample.
+    """
+
+    def __init__(self, root, paths, offsets, labels):
+        self.root = root
+        self.paths = paths
+        self.offsets = offsets
+        self.labels = labels
+
+    @classmethod
+    def from_list(cls, root, data_list, labeled=True):
+        """Parses a ``<relative path> <label> ...`` list file, one sample per line.
+
+        With ``labeled=False`` the label column is optional and missing labels are -1.
+        """
+        names, labels = [], []
+        with open(data_list, 'rb') as f:
+            for line in f:
+                tokens = line.split()
+                if not tokens:
+                    continue
+                if len(tokens) < 2 and labeled:
+                    raise RuntimeError("Malformed list file: " + data_list)
+                # extra columns are ignored
+                names.append(tokens[0])
+                labels.append(int(tokens[1]) if len(tokens) > 1 else -1)
+        return cls.from_paths(root, names, labels)
+
+    @classmethod
+    def from_paths(cls, root, names, labels=None):
+        """Packs a sequence of relative paths (bytes); unlabeled samples get label -1."""
+        names = list(names)
+        if labels is None:
+            labels = np.full(len(names), -1, dtype=np.int32)
+        offsets = np.zeros(len(names) + 1, dtype=np.int64)
+        np.cumsum(np.fromiter(map(len, names), dtype=np.int64, count=len(names)), out=offsets[1:])
+        paths = np.frombuffer(b''.join(names), dtype=np.uint8)
+        return cls(root, paths, offsets, np.asarray(labels, dtype=np.int32))
+
+    def path(self, index):
+        start, end = self.offsets[index], self.offsets[index + 1]
+        return os.path.join(self.root, self.paths[start:end].tobytes().decode('utf-8'))
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return self.path(index), int(self.labels[index])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __len__(self):
+        return len(self.labels)
+
+
 def make_dataset(data_path, data_list, extensions):
-    images = []
-    fid = open(data_list, 'r')
-    for line in fid.readlines():
-        data = line.strip('\n').split(' ')
-        path = os.path.join(data_path, data[0])
-        item = (path, np.int64(data[1]))
-        images.append(item)
-    fid.close()
-    return images
+    # a prebuilt index, e.g. from the semantic store cache, is used as is
+    if isinstance(data_list, SampleIndex):
+        return data_list
+    return SampleIndex.from_list(data_path, data_list)
 
 
 def lowfft(img):
@@ -87,15 +153,21 @@ class DatasetFolder(data.Dataset):
         transform (callable, optional): A function/transform that takes in a sample and returns a transformed version.
             E.g, ``transforms.RandomCrop`` for images.
         target_transform (callable, optional): A function/transform that takes in the target and transforms it.
+        fetch_threads (int, optional): Decode threads used by ``__getitems__`` in every
+            loader worker. 0 fetches the samples of a batch one by one.
+        repeats (int, optional): Number of independently augmented views produced from
+            one load of an image. Views are stacked along a new leading dimension.
 
      Attributes:
         classes (list): List of the class names.
         class_to_idx (dict): Dict with items (class_name, class_index).
-        samples (list): List of (sample path, class_index) tuples
-        targets (list): The class_index value for each image in the dataset
+        samples (SampleIndex): Sequence of (sample path, class_index) tuples
+        targets (ndarray): The int32 class_index value for each image in the dataset
+        stats (PipelineStats): Optional stage timer (``utils.PipelineStats``), None disables timing
     """
 
-    def __init__(self, root, data_list, loader, extensions, transform=None,transform2=None, target_transform=None):
+    def __init__(self, root, data_list, loader, extensions, transform=None,transform2=None, target_transform=None,
+                 fetch_threads=0, repeats=1):
         samples = make_dataset(root, data_list, extensions)
         if len(samples) == 0:
             raise (RuntimeError("Found 0 files in subfolders of: " + root + "\n"
@@ -109,11 +181,16 @@ class DatasetFolder(data.Dataset):
         self.classes = []
         self.class_to_idx = []
         self.samples = samples
-        self.targets = [s[1] for s in samples]
+        self.targets = samples.labels
 
         self.transform = transform
         self.transform2 = transform2
         self.target_transform = target_transform
+        self.fetch_threads = fetch_threads
+        self.repeats = repeats
+        self.stats = None
+        self._pool = None
+        self._pool_pid = None
        # self.ratio = args.ratio
 
     def _find_classes(self, dir):
@@ -147,17 +224,13 @@ class DatasetFolder(data.Dataset):
             tuple: (sample, target) where target is class_index of the target class.
         """
         path, target = self.samples[index]
-        sample = self.loader(path)
+        sample = self._load(path)
 
         if self.transform is not None:
-            rand = random.uniform(0,1)
-            if rand < 0.3 :
-                sample = self.transform(sample)
-                sample = lowfft(sample)
-                sample = self.transform2(sample)
+            if self.repeats > 1:
+                sample = torch.stack([self._augment(sample) for _ in range(self.repeats)])
             else:
-                sample = self.transform(sample)
-                sample = self.transform2(sample)
+                sample = self._augment(sample)
 
         if self.target_transform is not None:
             target = self.target_transform(target)
@@ -166,6 +239,66 @@ class DatasetFolder(data.Dataset):
 
         return sample, target
 
+    def _timed(self, stage, fn, *args):
+        if self.stats is None:
+            return fn(*args)
+        start = time.perf_counter()
+        out = fn(*args)
+        self.stats.record(stage, time.perf_counter() - start)
+        return out
+
+    def _load(self, path):
+        if self.stats is None or self.loader not in (default_loader, pil_loader):
+            return self._timed('load', self.loader, path)
+        # split file I/O from decoding so the two can be told apart
+        with open(path, 'rb') as f:
+            buf = self._timed('read', f.read)
+        return self._timed('decode', pil_loader, io.BytesIO(buf))
+
+    def _augment(self, sample):
+        rand = random.uniform(0,1)
+        if rand < 0.3 :
+            sample = self._timed('transform', self.transform, sample)
+            sample = self._timed('lowfft', lowfft, sample)
+            sample = self._timed('transform2', self.transform2, sample)
+        else:
+            sample = self._timed('transform', self.transform, sample)
+            sample = self._timed('transform2', self.transform2, sample)
+        return sample
+
+    def __getitems__(self, indices):
+        """
+        Args:
+            indices (list): Indices of one batch, as yielded by the batch sampler.
+
+        Returns:
+            tuple: (samples, targets) stacked in the worker, or a list of samples
+            when ``fetch_threads`` is 0. Use :meth:`collate` as the loader's collate_fn.
+        """
+        if self.fetch_threads <= 0:
+            return [self[i] for i in indices]
+        # decoding and PIL resampling release the GIL, so threads overlap them
+        batch = list(self._fetch_pool().map(self.__getitem__, indices))
+        return tuple(self._timed('collate', default_collate, batch))
+
+    def _fetch_pool(self):
+        # one pool per loader worker process, created on first use
+        if self._pool is None or self._pool_pid != os.getpid():
+            self._pool = ThreadPoolExecutor(max_workers=self.fetch_threads)
+            self._pool_pid = os.getpid()
+        return self._pool
+
+    def collate(self, batch):
+        """collate_fn that passes batches stacked by ``__getitems__`` through."""
+        if isinstance(batch, tuple):
+            return batch
+        return self._timed('collate', default_collate, batch)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_pool'] = None
+        return state
+
     def __len__(self):
         return len(self.samples)
 
@@ -180,10 +313,84 @@ class DatasetFolder(data.Dataset):
         return fmt_str
 
 
+class RepeatAugSampler(data.Sampler):
+    """Samples a class-stratified subset of the dataset for repeated augmentation.
+
+    Each image yields ``repeats`` views, so only ``ceil(N / repeats)`` images are
+    drawn per epoch. Every class contributes about ``1 / repeats`` of its images,
+    which keeps the number of views per epoch and the class balance of a plain
+    shuffled epoch. A different subset is drawn every epoch.
+
+    Args:
+        targets (sequence): Class index of every sample.
+        repeats (int): Views produced per loaded image.
+        seed (int, optional): Base seed, combined with the epoch set by ``set_epoch``.
+        num_replicas (int, optional): Number of distributed processes.
+        rank (int, optional): Rank of this process, which gets every num_replicas-th image.
+    """
+
+    def __init__(self, targets, repeats, seed=0, num_replicas=1, rank=0):
+        targets = np.asarray(targets)
+        self.repeats = repeats
+        self.seed = seed
+        self.epoch = 0
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.total_size = int(math.ceil(len(targets) / float(repeats)))
+        self.num_samples = int(math.ceil(self.total_size / float(num_replicas)))
+        self.class_indices = [np.flatnonzero(targets == c) for c in np.unique(targets)]
+        self.size = len(targets)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        rng = np.random.RandomState(self.seed + self.epoch)
+        # a random rank spread evenly over [0, 1) within each class, so taking the
+        # lowest keys picks every class in proportion to its size
+        keys = np.empty(self.size)
+        for idx in self.class_indices:
+            keys[idx] = (rng.permutation(len(idx)) + rng.uniform(size=len(idx))) / len(idx)
+        order = np.argsort(keys, kind='stable')[:self.total_size]
+        rng.shuffle(order)
+        # pad so that every rank gets the same number of images
+        order = np.resize(order, self.num_samples * self.num_replicas)
+        return iter(order[self.rank::self.num_replicas].tolist())
+
+    def __len__(self):
+        return self.num_samples
+
+
+class ShardSampler(data.Sampler):
+    """Contiguous, unpadded shard of a dataset for distributed evaluation.
+
+    Unlike DistributedSampler nothing is padded or interleaved, so concatenating
+    the per-rank results in rank order restores the dataset order exactly.
+
+    Args:
+        size (int): Dataset length.
+        num_replicas (int): Number of distributed processes.
+        rank (int): Rank of this process.
+    """
+
+    def __init__(self, size, num_replicas, rank):
+        per_rank = int(math.ceil(size / float(num_replicas)))
+        self.start = min(rank * per_rank, size)
+        self.end = min(self.start + per_rank, size)
+
+    def __iter__(self):
+        return iter(range(self.start, self.end))
+
+    def __len__(self):
+        return self.end - self.start
+
+
 IMG_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.ppm', '.bmp', '.pgm', '.tif']
 
 
 def pil_loader(path):
+    if hasattr(path, 'read'):
+        return Image.open(path).convert('RGB')
     # open path as file to avoid ResourceWarning (https://github.com/python-pillow/Pillow/issues/835)
     with open(path, 'rb') as f:
         img = Image.open(f)
@@ -208,6 +415,7 @@ def default_loader(path):
 
 
 def sk_loader(path):
+    import skimage.io
     return skimage.io.imread(path)
 
 
@@ -233,11 +441,11 @@ class ImageFolder(DatasetFolder):
      Attributes:
         classes (list): List of the class names.
         class_to_idx (dict): Dict with items (class_name, class_index).
-        imgs (list): List of (image path, class_index) tuples
+        imgs (SampleIndex): Sequence of (image path, class_index) tuples
     """
 
     def __init__(self, root, data_list, transform=None, transform2=None,target_transform=None,
-                 loader='default_loader'):
+                 loader='default_loader', fetch_threads=0, repeats=1):
         if loader == 'sk_loader':
             loader = sk_loader
         else:
@@ -246,5 +454,7 @@ class ImageFolder(DatasetFolder):
         super(ImageFolder, self).__init__(root, data_list, loader, IMG_EXTENSIONS,
                                           transform=transform,
                                           transform2=transform2,
-                                          target_transform=target_transform)
+                                          target_transform=target_transform,
+                                          fetch_threads=fetch_threads,
+                                          repeats=repeats)
         self.imgs = self.samples
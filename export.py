@@ -0,0 +1,249 @@
+"""Exports a trained model as a frozen inference graph (TorchScript or ONNX).
+
+    python export.py --resume cub.model --out fpa.pt
+    python export.py --resume cub.model --out fpa.onnx --format onnx
+
+The exported graph (``InferenceGraph``) computes the eval-mode outputs of
+``fpa.Model`` with
+- every BatchNorm folded into the convolution before it,
+- the modules the forward pass never uses (odr_proj2, zsr_proj, p_linear, ...) dropped,
+- the normalized class prototypes ``zsr_sem(sf)`` precomputed,
+- the FFT of the FFT module replaced by real DFT matrix products.
+
+``GlobalFilter`` only keeps the magnitude of the phase-mixed spectrum, which the
+phase mixing does not change, so its output is ``log(1 + |fft2(x)|)`` and the
+graph is deterministic. The input is a normalized ``N x 3 x H x W`` float batch
+of the size given by ``--image-size``; the output is
+``(odr_logit, zsr_logit, zsr_logit_aux, fft_att, fft_logit)``. The export is
+checked against the eager model and CPU latencies are reported.
+"""
+import argparse
+import copy
+import math
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+OUTPUTS = ['odr_logit', 'zsr_logit', 'zsr_logit_aux', 'fft_att', 'fft_logit']
+
+
+def fold_bn(module):
+    """Folds eval-mode BatchNorm2d layers into the convolutions before them, in place.
+
+    Handles ``conv -> bn`` pairs in Sequentials and ``convK``/``bnK`` attribute
+    pairs (Bottleneck, the stem); folded BN layers become Identity.
+
+    Returns:
+        int: Number of folded layers.
+    """
+    folded = 0
+    for m in list(module.modules()):
+        children = m._modules
+        if isinstance(m, nn.Sequential):
+            pairs = [(a, b) for a, b in zip(list(children)[:-1], list(children)[1:])]
+        else:
+            pairs = [('conv' + name[2:], name) for name in children if name.startswith('bn')]
+        for conv, bn in pairs:
+            if isinstance(children.get(conv), nn.Conv2d) and isinstance(children.get(bn), nn.BatchNorm2d):
+                children[conv] = fuse_conv_bn_eval(children[conv], children[bn])
+                children[bn] = nn.Identity()
+                folded += 1
+    return folded
+
+
+def dft_matrices(n):
+    """Real and imaginary part (up to sign) of the n-point DFT matrix."""
+    k = torch.arange(n, dtype=torch.float64)
+    angle = 2 * math.pi * torch.outer(k, k) / n
+    return torch.cos(angle).float(), torch.sin(angle).float()
+
+
+def sqrtm(A, iterN):
+    """Newton-Schulz matrix square root, the forward pass of ``MPNCOV.Sqrtm``."""
+    I3 = 3.0 * torch.eye(A.size(1), dtype=A.dtype, device=A.device).expand_as(A)
+    normA = A.diagonal(dim1=1, dim2=2).sum(1).view(-1, 1, 1)
+    A = A / normA
+    ZY = 0.5 * (I3 - A)
+    Y = A.bmm(ZY)
+    Z = ZY
+    for _ in range(1, iterN - 1):
+        ZY = 0.5 * (I3 - Z.bmm(Y))
+        Y = Y.bmm(ZY)
+        Z = ZY.bmm(Z)
+    ZY = 0.5 * Y.bmm(I3 - Z.bmm(Y))
+    return ZY * torch.sqrt(normA)
+
+
+class InferenceGraph(nn.Module):
+    """Export-friendly eval forward pass of a trained ``fpa.Model``.
+
+    Args:
+        model (Model): Trained model; it is copied, not modified.
+        image_size (int): Input height and width; fixes the size of the DFT matrices.
+    """
+
+    def __init__(self, model, image_size=480):
+        super(InferenceGraph, self).__init__()
+        model = copy.deepcopy(model).eval()
+        self.folded = fold_bn(model)
+        self.stem = nn.Sequential(model.conv1, model.relu, model.maxpool)
+        self.layer1, self.layer2, self.layer3, self.layer4 = model.layer1, model.layer2, model.layer3, model.layer4
+        self.match_channels_x2 = model.match_channels_x2
+        self.match_channels_x3 = model.match_channels_x3
+        self.odr_proj = model.odr_proj1
+        self.odr_spatial = model.odr_spatial
+        self.odr_channel = model.odr_channel
+        self.odr_classifier = model.odr_classifier
+        self.cov = model.cov
+        self.fft_proj = model.fft_proj
+        self.attributes = model.fft2
+        self.zsr_aux = model.zsr_aux
+        self.parts = model.parts
+        self.map_threshold = model.map_threshold
+        with torch.no_grad():
+            # the ZSR classifier only depends on the class semantics
+            self.register_buffer('prototypes', F.normalize(model.zsr_sem(model.sf), p=2, dim=1))
+            self.register_buffer('sf_t', model.sf.t().contiguous())
+            size = self._trunk(torch.zeros(1, 3, image_size, image_size, device=model.sf.device)).shape[2:]
+        h, w = size
+        dim = self.odr_classifier.in_features
+        dim = int((math.sqrt(8 * dim + 1) - 1) / 2)
+        # lower triangle in row-major order, as MPNCOV.Triuvec
+        rows, cols = torch.tril_indices(dim, dim)
+        self.register_buffer('triu_index', rows * dim + cols)
+        for name, n in (('h', h), ('w', w)):
+            cos, sin = dft_matrices(n)
+            self.register_buffer('cos_' + name, cos)
+            self.register_buffer('sin_' + name, sin)
+        self.scale = 1. / math.sqrt(h * w)
+
+    def _trunk(self, x):
+        x = self.stem(x)
+        x2 = self.layer2(self.layer1(x))
+        x3 = self.layer3(x2)
+        x4 = self.layer4(x3)
+        x2 = self.match_channels_x2(F.interpolate(x2, size=x4.shape[2:], mode='bilinear', align_corners=True))
+        x3 = self.match_channels_x3(F.interpolate(x3, size=x4.shape[2:], mode='bilinear', align_corners=True))
+        return x2 + x3 + x4
+
+    def _odr(self, last_conv):
+        x = self.odr_proj(last_conv)
+        x1 = (self.odr_channel(x) * x + x).flatten(2)
+        x2 = (self.odr_spatial(x) * x + x).flatten(2)
+        x1 = x1 - x1.mean(2, keepdim=True)
+        x2 = x2 - x2.mean(2, keepdim=True)
+        A = x1.bmm(x2.transpose(1, 2)) / x1.size(2)
+        return self.odr_classifier(sqrtm(A, 5).flatten(1)[:, self.triu_index])
+
+    def _log_magnitude(self, x):
+        # |fft2(x, norm='ortho')| from real matrix products: F = (C_h - iS_h) x (C_w - iS_w)
+        p = x.matmul(self.cos_w)
+        q = x.matmul(self.sin_w)
+        real = self.cos_h.matmul(p) - self.sin_h.matmul(q)
+        imag = self.sin_h.matmul(p) + self.cos_h.matmul(q)
+        return torch.log(1 + torch.sqrt((real ** 2 + imag ** 2) * self.scale ** 2 + 1e-8))
+
+    def _fft(self, last_conv):
+        weights = torch.softmax(self.cov(last_conv), dim=1)
+        batch, parts = weights.shape[:2]
+        threshold = self.map_threshold * weights.view(batch, -1).max(dim=1)[0].view(batch, 1)
+        local_max = weights.view(batch, parts, -1).max(dim=2)[0]
+        weights = weights * local_max.ge(threshold).float().view(batch, parts, 1, 1)
+        magnitude = self._log_magnitude(last_conv)
+        # Model._fft_head overwrites Y for every part, only the last one is used
+        Y = magnitude * weights[:, parts - 1:parts] + magnitude
+        return self.fft_proj(Y).flatten(1)
+
+    def forward(self, x):
+        last_conv = self._trunk(x)
+        odr_logit = self._odr(last_conv)
+        fft_last = self._fft(last_conv)
+        fft_att = self.attributes(fft_last)
+        zsr_logit = F.normalize(fft_last, p=2, dim=1).mm(self.prototypes.t())
+        return odr_logit, zsr_logit, self.zsr_aux(fft_last), fft_att, fft_att.mm(self.sf_t)
+
+
+@torch.no_grad()
+def max_error(reference, outputs):
+    """Largest absolute difference per output, relative to the largest reference value."""
+    return dict((name, float((r - o).abs().max() / r.abs().max().clamp(min=1e-12)))
+                for name, r, o in zip(OUTPUTS, reference, outputs))
+
+
+@torch.no_grad()
+def latency_ms(fn, batch, repeats):
+    fn(batch)
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn(batch)
+        times.append(time.perf_counter() - start)
+    return 1e3 * float(np.median(times))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='export a trained fpa model as a frozen inference graph')
+    parser.add_argument('--resume', required=True, help='trained checkpoint')
+    parser.add_argument('--out', required=True, help='output file')
+    parser.add_argument('--format', default='torchscript', choices=['torchscript', 'onnx'])
+    parser.add_argument('--image-size', default=480, type=int, help='input height and width')
+    parser.add_argument('--opset', default=17, type=int, help='ONNX opset')
+    parser.add_argument('-b', '--batch-size', default=8, type=int, help='batch size of the latency benchmark')
+    parser.add_argument('--repeats', default=10, type=int, help='timed forward passes')
+    parser.add_argument('--tolerance', default=1e-3, type=float, help='largest accepted relative output error')
+    args = parser.parse_args()
+
+    from inference import load_model
+
+    model, _, _, _ = load_model(args.resume, device='cpu')
+    graph = InferenceGraph(model, args.image_size).eval()
+    print('=> folded {} BatchNorm layers, {:.1f}M -> {:.1f}M parameters'.format(
+        graph.folded, sum(p.numel() for p in model.parameters()) / 1e6,
+        sum(p.numel() for p in graph.parameters()) / 1e6))
+
+    example = torch.randn(2, 3, args.image_size, args.image_size)
+    with torch.no_grad():
+        reference, _ = model(example)
+        runners = [('eager', model, lambda x: model(x)[0]), ('folded', graph, graph)]
+        if args.format == 'torchscript':
+            exported = torch.jit.freeze(torch.jit.trace(graph, example))
+            exported.save(args.out)
+            exported = torch.jit.load(args.out)
+            runners.append(('torchscript', exported, exported))
+        else:
+            torch.onnx.export(graph, (example,), args.out, input_names=['image'], output_names=OUTPUTS,
+                              dynamic_axes=dict((name, {0: 'batch'}) for name in ['image'] + OUTPUTS),
+                              opset_version=args.opset, dynamo=False)
+            try:
+                import onnxruntime
+            except ImportError:
+                onnxruntime = None
+                print('=> onnxruntime is not installed, skipping the check of the ONNX graph')
+            if onnxruntime is not None:
+                session = onnxruntime.InferenceSession(args.out, providers=['CPUExecutionProvider'])
+                run = lambda x: [torch.from_numpy(o) for o in session.run(None, {'image': x.numpy()})]
+                runners.append(('onnxruntime', session, run))
+    print('=> exported to {}'.format(args.out))
+
+    failed = False
+    print('{:>12} {:>13} {:>13} {:>13} {:>13} {:>13} {:>9} {:>10}'.format(
+        'runtime', *(OUTPUTS + ['ms (b=1)', 'ms (b={})'.format(args.batch_size)])))
+    for name, _, run in runners:
+        with torch.no_grad():
+            errors = max_error(reference, run(example))
+        failed |= max(errors.values()) > args.tolerance
+        print('{:>12} {} {:9.1f} {:10.1f}'.format(
+            name, ' '.join('{:13.2e}'.format(errors[o]) for o in OUTPUTS),
+            latency_ms(run, torch.randn(1, 3, args.image_size, args.image_size), args.repeats),
+            latency_ms(run, torch.randn(args.batch_size, 3, args.image_size, args.image_size),
+                       max(1, args.repeats // 4))))
+    if failed:
+        raise SystemExit('exported graph differs from the eager model by more than {}'.format(args.tolerance))
+
+
+if __name__ == '__main__':
+    main()
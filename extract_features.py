@@ -0,0 +1,198 @@
+"""Writes model features of an image list to a chunked HDF5 file.
+
+    python extract_features.py --resume cub.model --list test_unseen.list --out unseen.h5 \\
+        --features odr_x,x_all,fft_att --compression gzip
+
+``--list`` is a list of the dataset (``./data/<data>/<list>``) or any
+``<relative path> [label]`` file, with paths relative to ``--root``. Every
+selected feature becomes an ``N x ...`` dataset, next to ``labels``, ``paths``
+and ``index`` (position in the list; undecodable images are skipped). A
+background thread appends finished batches to the file while the next ones are
+computed; at most ``--queue`` batches wait for it.
+"""
+import argparse
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+import torch
+import torch.utils.data as data
+
+from checkpointing import fingerprint
+from dataset.folder import SampleIndex
+from infer import ImageList, collate
+from inference import load_model
+from utils import Uint8Normalize, preprocess_strategy
+
+# name -> function of the model outputs (logits, feats)
+FEATURES = {
+    'odr_x': lambda logits, feats: feats[0],
+    'x_all': lambda logits, feats: feats[1],
+    'last_conv': lambda logits, feats: feats[2],
+    'fft_att': lambda logits, feats: logits[3],
+    'odr_logit': lambda logits, feats: logits[0],
+    'zsr_logit': lambda logits, feats: logits[1],
+}
+
+MAX_CHUNK_BYTES = 4 << 20
+
+
+class H5Writer(object):
+    """Appends batches to resizable, chunked HDF5 datasets on a background thread.
+
+    Datasets are created from the first batch: every array of a batch becomes an
+    extensible ``N x ...`` dataset chunked along ``N`` by ``chunk_rows``, fewer for
+    rows so large (e.g. spatial maps) that a chunk would exceed ``MAX_CHUNK_BYTES``.
+
+    Args:
+        filename (string): Output file, written to ``<filename>.tmp`` until ``close``.
+        chunk_rows (int): Rows per HDF5 chunk.
+        compression (string, optional): h5py filter, e.g. ``'gzip'`` or ``'lzf'``.
+        max_pending (int): Batches that may wait for the writer before ``write`` blocks.
+        attrs (dict, optional): File attributes.
+    """
+
+    def __init__(self, filename, chunk_rows=256, compression=None, max_pending=4, attrs=None):
+        import h5py
+        self.filename = filename
+        self.chunk_rows = chunk_rows
+        self.compression = compression
+        self.file = h5py.File(filename + '.tmp', 'w')
+        self.file.attrs.update(attrs or {})
+        self.rows = 0
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._error = None
+        self._thread = threading.Thread(target=self._write, daemon=True)
+        self._thread.start()
+
+    def _create(self, name, array):
+        import h5py
+        strings = array.dtype.kind in ('U', 'O')
+        row_bytes = array[:1].nbytes if not strings else 64
+        rows = max(1, min(self.chunk_rows, MAX_CHUNK_BYTES // max(1, row_bytes)))
+        self.file.create_dataset(name, shape=(0,) + array.shape[1:], maxshape=(None,) + array.shape[1:],
+                                 chunks=(rows,) + array.shape[1:],
+                                 dtype=h5py.string_dtype() if strings else array.dtype,
+                                 compression=None if strings else self.compression)
+
+    def _append(self, batch):
+        n = len(next(iter(batch.values())))
+        for name, array in batch.items():
+            if name not in self.file:
+                self._create(name, array)
+            dset = self.file[name]
+            dset.resize(self.rows + n, axis=0)
+            dset[self.rows:self.rows + n] = array
+        self.rows += n
+
+    def _write(self):
+        while True:
+            batch = self._queue.get()
+            if batch is None:
+                self._queue.task_done()
+                return
+            try:
+                if self._error is None:
+                    self._append(batch)
+            except Exception as e:
+                self._error = e
+            self._queue.task_done()
+
+    def _check(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def write(self, batch):
+        """Queues a dict of equally long numpy arrays."""
+        self._check()
+        self._queue.put(batch)
+
+    def close(self, discard=False):
+        """Waits for the queued batches and moves the finished file into place (or deletes it)."""
+        self._queue.put(None)
+        self._thread.join()
+        self.file.close()
+        if discard:
+            os.remove(self.filename + '.tmp')
+            return
+        self._check()
+        os.replace(self.filename + '.tmp', self.filename)
+
+
+@torch.no_grad()
+def main():
+    parser = argparse.ArgumentParser(description='fpa feature extraction')
+    parser.add_argument('--resume', required=True, help='trained checkpoint')
+    parser.add_argument('--list', required=True, help='list name in the dataset directory or a list file')
+    parser.add_argument('--root', default=None, help='image root of a list file (default: the dataset images)')
+    parser.add_argument('--out', required=True, help='output HDF5 file')
+    parser.add_argument('--features', default='odr_x,x_all,fft_att',
+                        help='comma-separated subset of ' + ','.join(FEATURES))
+    parser.add_argument('--pool', action='store_true', help='average spatial maps (last_conv) to vectors')
+    parser.add_argument('--dtype', default='float32', choices=['float16', 'float32'])
+    parser.add_argument('--compression', default=None, choices=['gzip', 'lzf'])
+    parser.add_argument('--chunk-rows', default=256, type=int, help='rows per HDF5 chunk')
+    parser.add_argument('--queue', default=4, type=int, help='batches buffered for the writer thread')
+    parser.add_argument('-b', '--batch-size', default=64, type=int)
+    parser.add_argument('-j', '--workers', default=4, type=int, help='data loading workers')
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('-p', '--print-freq', default=20, type=int)
+    args = parser.parse_args()
+
+    names = args.features.split(',')
+    for name in names:
+        if name not in FEATURES:
+            parser.error('unknown feature {}, choose from {}'.format(name, ', '.join(FEATURES)))
+    device = torch.device(args.device)
+    model, margs, store, _ = load_model(args.resume, device=device)
+    margs.uint8_transport = True
+    margs.flippingtest = False
+    _, _, val_transforms, val_transforms2 = preprocess_strategy(margs.data, margs)
+    if os.path.isfile(args.list):
+        root = args.root if args.root is not None else store.img_path
+        samples = SampleIndex.from_list(root, args.list, labeled=False)
+    else:
+        samples = store.samples(args.list)
+    loader = data.DataLoader(ImageList(samples, val_transforms, val_transforms2), batch_size=args.batch_size,
+                             num_workers=args.workers, collate_fn=collate, pin_memory=(device.type == 'cuda'))
+    to_float = Uint8Normalize()
+
+    writer = H5Writer(args.out, args.chunk_rows, args.compression, args.queue,
+                      attrs={'checkpoint': os.path.abspath(args.resume), 'fingerprint': fingerprint(args.resume),
+                             'list': args.list, 'data': margs.data})
+    done, skipped, start = 0, 0, time.time()
+    try:
+        for i_batch, (images, indices, failed) in enumerate(loader):
+            for i, e in failed:
+                print('=> skipping {}: {}'.format(samples[i][0], e))
+            skipped += len(failed)
+            if images is None:
+                continue
+            logits, feats = model(to_float(images.to(device, non_blocking=True)))
+            batch = {}
+            for name in names:
+                x = FEATURES[name](logits, feats)
+                if args.pool and x.dim() == 4:
+                    x = x.mean((2, 3))
+                batch[name] = x.to(getattr(torch, args.dtype)).cpu().numpy()
+            batch['labels'] = np.asarray([samples[i][1] for i in indices], dtype=np.int32)
+            batch['paths'] = np.asarray([os.path.relpath(samples[i][0], samples.root or '.') for i in indices],
+                                        dtype=object)
+            batch['index'] = np.asarray(indices, dtype=np.int64)
+            writer.write(batch)
+            done += len(indices)
+            if i_batch % args.print_freq == 0:
+                print('=> {}/{} images ({:.1f} img/s)'.format(done, len(samples), done / (time.time() - start)))
+    except BaseException:
+        writer.close(discard=True)
+        raise
+    writer.close()
+    print('=> wrote {} images to {} ({} skipped, {:.1f} img/s)'.format(done, args.out, skipped,
+                                                                   done / (time.time() - start)))
+
+
+if __name__ == '__main__':
+    main()
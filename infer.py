@@ -0,0 +1,178 @@
+"""Streams an image collection through a trained model and writes per-image predictions.
+
+    python infer.py --resume cub.model --list photos.list --root /data/photos --out preds
+    python infer.py --resume cub.model --dir /data/photos --out preds --format jsonl
+
+A list holds one ``<relative path> [label]`` per line; ``--dir`` scores every
+image below a directory. Predictions are written shard by shard to
+``<out>/shard-00000.csv`` etc. while the images are read, so memory does not
+grow with the collection. A shard is written to ``.part`` and renamed once
+complete; rerunning the same command skips finished shards and only rescores
+the interrupted one. Images that cannot be decoded get a row with ``error`` set.
+"""
+import argparse
+import csv
+import hashlib
+import json
+import os
+import time
+
+import torch
+import torch.utils.data as data
+
+from dataset.folder import SampleIndex, is_image_file, pil_loader
+from inference import Predictor
+
+FIELDS = ['path', 'label', 'class', 'domain', 'confidence', 'odr_confidence', 'topk', 'error']
+
+
+def dir_samples(root):
+    """SampleIndex of all images below ``root``, in sorted order."""
+    names = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for name in sorted(filenames):
+            if is_image_file(name):
+                names.append(os.path.relpath(os.path.join(dirpath, name), root).encode('utf-8'))
+    return SampleIndex.from_paths(root, names)
+
+
+class ImageList(data.Dataset):
+    """Preprocessed images of a SampleIndex with their index; undecodable ones carry the error instead."""
+
+    def __init__(self, samples, transform, transform2):
+        self.samples = samples
+        self.transform = transform
+        self.transform2 = transform2
+
+    def __getitem__(self, index):
+        path, _ = self.samples[index]
+        try:
+            return index, self.transform2(self.transform(pil_loader(path))), None
+        except (IOError, OSError, ValueError) as e:
+            return index, None, str(e)
+
+    def __len__(self):
+        return len(self.samples)
+
+
+def collate(batch):
+    """Stacks the decoded images of a batch and sets the failed ones aside."""
+    ok = [(i, x) for i, x, _ in batch if x is not None]
+    images = torch.stack([x for _, x in ok]) if ok else None
+    return images, [i for i, _ in ok], [(i, e) for i, x, e in batch if x is None]
+
+
+class ShardWriter(object):
+    """Appends rows to ``<path>.part`` and renames it to ``path`` on ``close``."""
+
+    def __init__(self, path, fmt):
+        self.path = path
+        self.fmt = fmt
+        self.file = open(path + '.part', 'w', newline='')
+        if fmt == 'csv':
+            self.writer = csv.DictWriter(self.file, FIELDS)
+            self.writer.writeheader()
+
+    def write(self, row):
+        if self.fmt == 'csv':
+            row = dict(row, topk=' '.join('{}:{:.6f}'.format(c, p) for c, p in row.get('topk', [])))
+            self.writer.writerow(row)
+        else:
+            self.file.write(json.dumps(row) + '\n')
+
+    def close(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        os.replace(self.path + '.part', self.path)
+
+
+def check_manifest(out, manifest):
+    """Refuses to resume into ``out`` if it was written for another model, input or setting."""
+    path = os.path.join(out, 'manifest.json')
+    if os.path.exists(path):
+        with open(path) as f:
+            previous = json.load(f)
+        if previous != manifest:
+            changed = sorted(k for k in set(previous) | set(manifest) if previous.get(k) != manifest.get(k))
+            raise SystemExit('{} holds predictions for a different run (changed: {}); use another --out'.format(
+                out, ', '.join(changed)))
+        return
+    os.makedirs(out, exist_ok=True)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(path + '.tmp', path)
+
+
+def shard_batches(shards, shard_size, size, batch_size):
+    for shard in shards:
+        end = min((shard + 1) * shard_size, size)
+        for start in range(shard * shard_size, end, batch_size):
+            yield range(start, min(start + batch_size, end))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='fpa batch inference')
+    parser.add_argument('--resume', required=True, help='trained checkpoint')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--list', help='list file with one "<relative path> [label]" per line')
+    source.add_argument('--dir', help='score every image below this directory')
+    parser.add_argument('--root', default='', help='directory the paths of --list are relative to')
+    parser.add_argument('--out', required=True, help='output directory')
+    parser.add_argument('--format', default='csv', choices=['csv', 'jsonl'])
+    parser.add_argument('--shard-size', default=10000, type=int, help='images per output file')
+    parser.add_argument('-b', '--batch-size', default=64, type=int)
+    parser.add_argument('-j', '--workers', default=4, type=int, help='data loading workers')
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--threshold', default=None, type=float,
+                        help='ODR confidence threshold (default: calibrated value in the checkpoint)')
+    parser.add_argument('--topk', default=5, type=int)
+    parser.add_argument('--quantize', default=None, choices=['dynamic'],
+                        help='int8 Linear layers for CPU inference (see quantize.py)')
+    args = parser.parse_args()
+
+    samples = SampleIndex.from_list(args.root, args.list, labeled=False) if args.list else dir_samples(args.dir)
+    num_shards = (len(samples) + args.shard_size - 1) // args.shard_size
+    predictor = Predictor(args.resume, args.device, args.threshold, args.topk, quantize=args.quantize)
+    check_manifest(args.out, {'model': predictor.fingerprint, 'source': os.path.abspath(args.list or args.dir),
+                              'samples': hashlib.blake2b(samples.paths.tobytes(), digest_size=16).hexdigest(),
+                              'size': len(samples), 'shard_size': args.shard_size, 'format': args.format,
+                              'threshold': predictor.threshold, 'topk': args.topk})
+
+    def shard_file(shard):
+        return os.path.join(args.out, 'shard-{:05d}.{}'.format(shard, args.format))
+
+    pending = [s for s in range(num_shards) if not os.path.exists(shard_file(s))]
+    print('=> {} images in {} shards, {} to score'.format(len(samples), num_shards, len(pending)))
+    if not pending:
+        return
+    loader = data.DataLoader(ImageList(samples, predictor.transform, predictor.transform2),
+                             batch_sampler=list(shard_batches(pending, args.shard_size, len(samples),
+                                                              args.batch_size)),
+                             num_workers=args.workers, collate_fn=collate,
+                             pin_memory=predictor.device.type == 'cuda')
+
+    shard, writer, done, start = None, None, 0, time.time()
+    for images, indices, failed in loader:
+        current = (indices or [i for i, _ in failed])[0] // args.shard_size
+        if current != shard:
+            if writer is not None:
+                writer.close()
+                print('=> shard {} done, {} images scored, {:.1f} img/s'.format(shard, done, done / (time.time() - start)))
+            shard, writer = current, ShardWriter(shard_file(current), args.format)
+        results = predictor.predict(images) if images is not None else []
+        rows = [(i, dict(r, error=None)) for i, r in zip(indices, results)]
+        rows += [(i, {'error': e}) for i, e in failed]
+        for i, result in sorted(rows, key=lambda r: r[0]):
+            path, label = samples[i]
+            row = {'path': os.path.relpath(path, samples.root or '.'), 'label': label}
+            row.update(result)
+            writer.write(row)
+        done += len(rows)
+    writer.close()
+    print('=> shard {} done, {} images scored, {:.1f} img/s'.format(shard, done, done / (time.time() - start)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+import io
+import os
+
+import numpy as np
+import torch
+from PIL import Image
+
+import models
+from checkpointing import fingerprint, load_checkpoint, strip_module_prefix
+from semantic import SemanticStore
+from utils import Uint8Normalize, adj_matrix, gzsl_predict, preprocess_strategy, softmax
+
+
+def model_args(checkpoint=None, **overrides):
+    """Arguments to rebuild a trained model.
+
+    Starts from the ``main.py`` defaults, applies the arguments saved in the
+    checkpoint (if it has them) and then ``overrides``.
+    """
+    from main import parser
+    args = parser.parse_args([])
+    if checkpoint is not None:
+        vars(args).update(checkpoint.get('args', {}))
+    vars(args).update(overrides)
+    return args
+
+
+def load_model(resume, device='cpu', data_root='./data', quantize=None, **overrides):
+    """Builds a model in eval mode from a checkpoint written by ``main.py``.
+
+    Args:
+        resume (string): Checkpoint path.
+        device: Device the model is built on.
+        data_root (string): Directory holding ``<data>/data_info.h5``.
+        quantize (string, optional): ``'dynamic'`` for int8 Linear layers on CPU
+            (see ``quantize.py``).
+        overrides: Replace saved training arguments, e.g. ``data='cub'``.
+
+    Returns:
+        tuple: (model, args, SemanticStore, checkpoint)
+    """
+    checkpoint = load_checkpoint(resume)
+    args = model_args(checkpoint, **overrides)
+    store = SemanticStore(os.path.join(data_root, args.data))
+    args.num_classes = store.num_classes
+    args.sf_size = store.sf_size
+    args.sf = store.all_att
+    args.adj = adj_matrix(store.num_classes)
+    arch = checkpoint.get('arch') or args.arch
+    model, _ = models.get_model(arch)(args=args, state_dict=strip_module_prefix(checkpoint['state_dict']),
+                                      device=device)
+    model.eval()
+    if quantize == 'dynamic':
+        from quantize import quantize_dynamic
+        model = quantize_dynamic(model)
+    elif quantize is not None:
+        raise ValueError('unknown quantization {}'.format(quantize))
+    return model, args, store, checkpoint
+
+
+class Predictor(object):
+    """Batched GZSL prediction with a trained model.
+
+    Images are preprocessed like the validation set, minus the random low-pass
+    augmentation the dataset applies, and shipped to the device as uint8. The GZSL
+    decision is the one ``post_process`` calibrated during training (see
+    ``utils.gzsl_predict``).
+
+    Args:
+        resume (string): Checkpoint path.
+        device: Device the model runs on.
+        threshold (float, optional): ODR confidence threshold; by default the
+            ``gzsl_threshold`` stored in the checkpoint.
+        topk (int): Number of ranked alternatives returned per image.
+        overrides: See ``load_model``.
+    """
+
+    def __init__(self, resume, device='cpu', threshold=None, topk=5, **overrides):
+        self.device = torch.device(device)
+        self.overrides = overrides
+        self.fixed_threshold = threshold
+        self.topk = topk
+        self.to_float = Uint8Normalize()
+        self.load(resume)
+
+    def load(self, resume):
+        """(Re)loads the model from ``resume`` and records its ``fingerprint``."""
+        model, args, store, checkpoint = load_model(resume, self.device, **self.overrides)
+        threshold = self.fixed_threshold
+        if threshold is None:
+            threshold = checkpoint.get('gzsl_threshold')
+        if threshold is None:
+            raise ValueError('{} has no calibrated gzsl_threshold, pass one explicitly'.format(resume))
+        args.uint8_transport = True
+        args.flippingtest = False
+        _, _, self.transform, self.transform2 = preprocess_strategy(args.data, args)
+        self.model, self.args, self.store = model, args, store
+        self.threshold = threshold
+        self.seen_class = np.asarray(store.array('seen_class'))
+        self.fingerprint = fingerprint(resume)
+        if self.overrides.get('quantize'):
+            # quantized models produce different logits
+            self.fingerprint += '-' + self.overrides['quantize']
+
+    def preprocess(self, data):
+        """Decodes encoded image bytes into a uint8 CHW tensor."""
+        img = Image.open(io.BytesIO(data)).convert('RGB')
+        return self.transform2(self.transform(img))
+
+    @torch.no_grad()
+    def logits(self, batch):
+        """Raw ODR and ZSR logits (numpy, N x classes) of a list or stacked batch of preprocessed images."""
+        if not torch.is_tensor(batch):
+            batch = torch.stack(batch)
+        input = batch.to(self.device, non_blocking=True)
+        logits, _ = self.model(self.to_float(input))
+        return logits[0].float().cpu().numpy(), logits[1].float().cpu().numpy()
+
+    def decide(self, odr_logit, zsl_logit):
+        """Turns logits into one prediction dict per image."""
+        odr_prob = softmax(odr_logit)
+        zsl_logit = zsl_logit.copy()
+        zsl_logit[:, self.seen_class] = -1
+        zsl_prob = softmax(zsl_logit)
+        pred, from_odr = gzsl_predict(odr_prob, zsl_prob, self.threshold)
+        results = []
+        for i in range(len(pred)):
+            prob = odr_prob[i] if from_odr[i] else zsl_prob[i]
+            ranked = np.argsort(-prob)[:self.topk]
+            results.append({'class': int(pred[i]),
+                            'domain': 'seen' if from_odr[i] else 'unseen',
+                            'confidence': float(prob[pred[i]]),
+                            'odr_confidence': float(odr_prob[i].max()),
+                            'topk': [[int(c), float(prob[c])] for c in ranked]})
+        return results
+
+    def predict(self, batch):
+        return self.decide(*self.logits(batch))
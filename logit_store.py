@@ -0,0 +1,36 @@
+import json
+import os
+
+import numpy as np
+
+SPLITS = ('odr_s', 'zsl_s', 'gt_s', 'odr_t', 'zsl_t', 'gt_t')
+
+
+def save_logits(filename, odr_s, zsl_s, gt_s, odr_t, zsl_t, gt_t, seen_c, unseen_c, probs=False, **meta):
+    """Writes the raw validation outputs of both test splits to an ``.npz`` file.
+
+    Together with the seen/unseen class ids this is everything ``utils.gzsl_scores``
+    needs, so evaluations can be recomputed without the model (see ``rescore.py``).
+    ``probs`` marks flipping-test outputs, which are averaged class probabilities
+    rather than logits; ``meta`` holds JSON-serializable extras such as the dataset.
+    """
+    tmp = filename + '.tmp'
+    with open(tmp, 'wb') as f:
+        np.savez(f, odr_s=odr_s, zsl_s=zsl_s, gt_s=gt_s, odr_t=odr_t, zsl_t=zsl_t, gt_t=gt_t,
+                 seen_class=np.asarray(seen_c), unseen_class=np.asarray(unseen_c), probs=np.asarray(probs),
+                 meta=np.asarray(json.dumps(meta)))
+    os.replace(tmp, filename)
+
+
+def load_logits(filename):
+    """Reads a file written by ``save_logits``.
+
+    Returns:
+        dict: The arrays of ``SPLITS``, ``seen_class``, ``unseen_class``, ``probs`` (bool)
+        and ``meta`` (dict).
+    """
+    with np.load(filename) as f:
+        store = dict((k, f[k]) for k in SPLITS + ('seen_class', 'unseen_class'))
+        store['probs'] = bool(f['probs'])
+        store['meta'] = json.loads(str(f['meta']))
+    return store
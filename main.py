@@ -4,11 +4,11 @@ import random
 import shutil
 import time
 import warnings
-import h5py
 import numpy as np
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import torch.nn.parallel
 import torch.backends.cudnn as cudnn
 import torch.distributed as dist
@@ -17,31 +17,37 @@ import torch.utils.data
 import torch.utils.data.distributed
 
 import sys
-import torchvision.transforms as transforms
 import datasets
 import models
+import autotune
+from checkpointing import CheckpointManager, load_checkpoint, strip_module_prefix
+from logit_store import save_logits
+from semantic import SemanticStore
 from utils import *
 from time import gmtime, strftime
-import torchvision
 
 
-model_names = sorted(name for name in models.__dict__
-                     if name.islower() and not name.startswith("__")
-                     and callable(models.__dict__[name]))
+model_names = models.model_names
 
 parser = argparse.ArgumentParser(description='PyTorch ImageNet Training')
 parser.add_argument('--data', '-d', metavar='DATA', default='cub',
                     help='dataset')
-parser.add_argument('--arch', '-a', metavar='ARCH', default='resnet18',
+parser.add_argument('--arch', '-a', metavar='ARCH', default='fpa',
                     choices=model_names,
                     help='model architecture: ' +
                          ' | '.join(model_names) +
-                         ' (default: resnet18)')
+                         ' (default: fpa)')
 parser.add_argument('--backbone', default='resnet18', help='backbone')
 parser.add_argument('--save_path', '-s', metavar='SAVE', default='',
                     help='saving path')
 parser.add_argument('-j', '--workers', default=3, type=int, metavar='N',
                     help='number of data loading workers (default: 4)')
+parser.add_argument('--autotune', dest='autotune', action='store_true',
+                    help='time loader settings on this machine and save the best to --loader-config')
+parser.add_argument('--loader-config', default='', type=str, metavar='PATH',
+                    help='tuned loader settings (default: <save_path>/loader_config.json)')
+parser.add_argument('--fetch-threads', default=0, type=int, metavar='N',
+                    help='decode threads per loader worker for batched fetching (default: 0, off)')
 parser.add_argument('--epochs', default=90, type=int, metavar='N',
                     help='number of total epochs to run')
 parser.add_argument('--start-epoch', default=0, type=int, metavar='N',
@@ -64,11 +70,15 @@ parser.add_argument('--print-freq', '-p', default=10, type=int,
                     metavar='N', help='print frequency (default: 10)')
 parser.add_argument('--resume', default='', type=str, metavar='PATH',
                     help='path to latest checkpoint (default: none)')
+parser.add_argument('--resume-optim', dest='resume_optim', action='store_true',
+                    help='also restore optimizer/RNG state and the epoch from --resume')
+parser.add_argument('--ckpt-trainable-only', dest='ckpt_trainable_only', action='store_true',
+                    help='store frozen weights once and only trainable tensors in every checkpoint')
 parser.add_argument('--pretrained', dest='pretrained', action='store_true',
                     help='use pre-trained model')
 parser.add_argument('--world-size', default=1, type=int,
-                    help='number of distributed processes')
-parser.add_argument('--dist-url', default='tcp://224.66.41.62:23456', type=str,
+                    help='number of distributed processes (taken from WORLD_SIZE under torchrun)')
+parser.add_argument('--dist-url', default='env://', type=str,
                     help='url used to set up distributed training')
 parser.add_argument('--dist-backend', default='gloo', type=str,
                     help='distributed backend')
@@ -76,6 +86,8 @@ parser.add_argument('--seed', default=None, type=int,
                     help='seed for initializing training. ')
 parser.add_argument('--gpu', default=None, type=int,
                     help='GPU id to use.')
+parser.add_argument('--cpu', dest='cpu', action='store_true',
+                    help='train and evaluate on CPU even if CUDA is available')
 parser.add_argument('--is_fix', dest='is_fix', action='store_true',
                     help='is_fix.')
 ''' data proc '''
@@ -83,6 +95,18 @@ parser.add_argument('--flippingtest', dest='flippingtest', action='store_true',
                     help='flipping test.')
 parser.add_argument('--aug', default='v7', type=str,
                     help='train augmentation')
+parser.add_argument('--accum-steps', default=1, type=int, metavar='K',
+                    help='split every batch into K micro-batches and accumulate their gradients '
+                         '(the effective batch stays --batch-size)')
+parser.add_argument('--checkpoint-segments', default='', type=str, metavar='SPEC',
+                    help='activation checkpointing, comma separated stage[:segments] with stages '
+                         'layer1-layer4, odr and fft, e.g. layer3:6,layer4,odr (default: off)')
+parser.add_argument('--repeat-aug', default=1, type=int, metavar='K',
+                    help='augmented views per loaded training image, counted into the batch')
+parser.add_argument('--profile-pipeline', dest='profile_pipeline', action='store_true',
+                    help='time every input pipeline stage and report per epoch')
+parser.add_argument('--uint8-transport', dest='uint8_transport', action='store_true',
+                    help='workers emit uint8 tensors, normalize on the training device')
 ''' loss '''
 parser.add_argument('--sigma', dest='sigma', default=0.5, type=float,
                     help='sigma.')
@@ -100,7 +124,10 @@ parser.add_argument('--odr', default=0, type=int,
 parser.add_argument("--LB", type=float, default=0.1, help="beta for FDA")
 parser.add_argument("--ratio", type=float, default=0.1, help="radius_ratio")
 parser.add_argument("--spacew", type=float, default=0.5, help="spaceweight")
+parser.add_argument('--save-logits', dest='save_logits', action='store_true',
+                    help='store the validation logits of every epoch for rescore.py')
 best_prec1 = 0
+to_float = Uint8Normalize()
 
 
 def main():
@@ -108,15 +135,39 @@ def main():
     args = parser.parse_args()
     print(args)
 
+    ''' distributed setup (torchrun sets WORLD_SIZE, RANK and LOCAL_RANK) '''
+    args.world_size = int(os.environ.get('WORLD_SIZE', args.world_size))
+    args.rank = int(os.environ.get('RANK', 0))
+    args.local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    args.distributed = args.world_size > 1
+
+    if args.distributed:
+        dist.init_process_group(backend=args.dist_backend, init_method=args.dist_url,
+                                world_size=args.world_size, rank=args.rank)
+
+    if args.cpu or not torch.cuda.is_available():
+        args.device = torch.device('cpu')
+        # share the cores between the processes on this node
+        local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', 1))
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // local_world_size))
+    elif args.distributed:
+        args.device = torch.device('cuda', args.local_rank)
+        torch.cuda.set_device(args.device)
+    else:
+        args.device = torch.device('cuda', args.gpu if args.gpu is not None else torch.cuda.current_device())
+
     ''' save path '''
-    if not os.path.exists(args.save_path):
-        os.makedirs(args.save_path)
+    os.makedirs(args.save_path, exist_ok=True)
 
     ''' random seed '''
-    if args.seed is not None:
-        random.seed(args.seed)
-    else:
+    if args.seed is None:
         args.seed = random.randint(1, 10000)
+    if args.distributed:
+        # all ranks must agree on the seed, it also names the output directory
+        seed = [args.seed]
+        dist.broadcast_object_list(seed, src=0)
+        args.seed = seed[0]
+    random.seed(args.seed)
 
     torch.manual_seed(args.seed)
     cudnn.deterministic = True
@@ -133,65 +184,85 @@ def main():
         args.lr2,
         args.epoch_decay,
         args.seed, )
-    os.makedirs(out_dir, exist_ok=True)
-    print("The output dictionary is {}".format(out_dir))
-    log_dir = out_dir + '/log{}.txt'.format(args.data)
-    with open(log_dir, 'w') as f:
-        f.write('Training Start:')
-        f.write(strftime("%a, %d %b %Y %H:%M:%S +0000", gmtime()) + '\n')
-        f.write(args.save_path)
+    if args.rank == 0:
+        os.makedirs(out_dir, exist_ok=True)
+        print("The output dictionary is {}".format(out_dir))
+        log_dir = out_dir + '/log{}.txt'.format(args.data)
+        with open(log_dir, 'w') as f:
+            f.write('Training Start:')
+            f.write(strftime("%a, %d %b %Y %H:%M:%S +0000", gmtime()) + '\n')
+            f.write(args.save_path)
+    else:
+        # only rank 0 writes logs and checkpoints
+        log_dir = None
 
     if args.gpu is not None:
         warnings.warn('You have chosen a specific GPU. This will completely '
                       'disable data parallelism.')
 
-    args.distributed = args.world_size > 1
-
-    if args.distributed:
-        dist.init_process_group(backend=args.dist_backend, init_method=args.dist_url,
-                                world_size=args.world_size)
-
     ''' data load info '''
-    data_info = h5py.File(os.path.join('./data', args.data, 'data_info.h5'), 'r')
-    img_path = str(data_info['img_path'][...]).replace("b'", '').replace("'", '')
+    store = SemanticStore(os.path.join('./data', args.data))
+    img_path = store.img_path
     print("1 ******************************")
     print(img_path)
-    nc = data_info['all_att'][...].shape[0]
-    sf_size = data_info['all_att'][...].shape[1]
-    semantic_data = {'seen_class': data_info['seen_class'][...],
-                     'unseen_class': data_info['unseen_class'][...],
-                     'all_class': np.arange(nc),
-                     'all_att': data_info['all_att'][...]}
+    nc = store.num_classes
+    semantic_data = store.semantic_data()
     ''' load semantic data'''
     args.num_classes = nc
-    args.sf_size = sf_size
+    args.sf_size = store.sf_size
     args.sf = semantic_data['all_att']
 
     adj = adj_matrix(nc)
     args.adj = adj
 
+    ''' checkpoint to resume from, its weights are copied in while the model is built '''
+    checkpoint = None
+    if args.resume:
+        if os.path.isfile(args.resume):
+            log_t1 = '=> loading checkpoint {}'.format(args.resume)
+            log_print(log_t1, log_dir)
+            checkpoint = load_checkpoint(args.resume)
+        else:
+            log_t4 = '=> no checkpoint found at {}'.format(args.resume)
+            log_print(log_t4, log_dir)
+    resume_state = strip_module_prefix(checkpoint['state_dict']) if checkpoint is not None else None
+
     ''' model building '''
     if args.pretrained:
         print("=> using pre-trained model '{}'".format(args.arch))
         best_prec1 = 0
-        model, criterion = models.__dict__[args.arch](pretrained=True, args=args)
+        model, criterion = models.get_model(args.arch)(pretrained=True, args=args, state_dict=resume_state,
+                                                     device=args.device)
     else:
         print("=> creating model '{}'".format(args.arch))
-        model, criterion = models.__dict__[args.arch](args=args)
+        model, criterion = models.get_model(args.arch)(args=args, state_dict=resume_state, device=args.device)
+    del resume_state
     print("=> is the backbone fixed: '{}'".format(args.is_fix))
 
-    if args.gpu is not None:
+    if args.accum_steps > 1:
+        # BN running statistics are updated once per micro-batch, keep their decay per optimizer step
+        for m in model.modules():
+            if isinstance(m, nn.BatchNorm2d) and m.momentum is not None:
+                m.momentum = 1 - (1 - m.momentum) ** (1. / args.accum_steps)
+
+    # odr_proj2 and p_linear take no part in the forward pass
+    if args.device.type == 'cpu':
+        model = model.to(args.device)
+        if args.distributed:
+            model = torch.nn.parallel.DistributedDataParallel(model, find_unused_parameters=True)
+    elif args.gpu is not None:
         model = model.cuda(args.gpu)
     elif args.distributed:
-        model.cuda()
-        model = torch.nn.parallel.DistributedDataParallel(model)
+        model.cuda(args.device)
+        model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[args.device.index],
+                                                          find_unused_parameters=True)
     else:
         if args.arch.startswith('alexnet') or args.arch.startswith('vgg'):
             model.features = torch.nn.DataParallel(model.features)
             model.cuda()
         else:
             model = torch.nn.DataParallel(model).cuda()
-    criterion = criterion.cuda(args.gpu)
+    criterion = criterion.to(args.device)
 
     ''' optimizer '''
     odr_params = [v for k, v in model.named_parameters() if 'odr_' in k]
@@ -206,66 +277,128 @@ def main():
                                 args.lr1, momentum=args.momentum, weight_decay=args.weight_decay)
 
     ''' optionally resume from a checkpoint'''
-    if args.resume:
-        if os.path.isfile(args.resume):
-            log_t1 = '=> loading checkpoint {}'.format(args.resume)
-            log_print(log_t1, log_dir)
-            checkpoint = torch.load(args.resume)
-            if (best_prec1 == 0):
-                best_prec1 = checkpoint['best_prec1']
-
-            log_t0 = '==========  no attenion only pinyu  =========='
-            log_print(log_t0, log_dir)
-
-            log_t2 = '=> pretrained acc {:.4F}'.format(best_prec1)
-            log_print(log_t2, log_dir)
-            model.load_state_dict(checkpoint['state_dict'])
-            log_t3 = '=> loaded checkpoint {} (epoch {})'.format(args.resume, checkpoint['epoch'])
-            log_print(log_t3, log_dir)
-        else:
-            log_t4 = '=> no checkpoint found at {}'.format(args.resume)
-            log_print(log_t4, log_dir)
+    if checkpoint is not None:
+        if (best_prec1 == 0):
+            best_prec1 = checkpoint['best_prec1']
+
+        log_t0 = '==========  no attenion only pinyu  =========='
+        log_print(log_t0, log_dir)
+
+        log_t2 = '=> pretrained acc {:.4F}'.format(best_prec1)
+        log_print(log_t2, log_dir)
+        if args.resume_optim:
+            for name, opt in [('optimizer', optimizer), ('odr_optimizer', odr_optimizer),
+                              ('zsr_optimizer', zsr_optimizer)]:
+                if name in checkpoint:
+                    opt.load_state_dict(checkpoint[name])
+            if 'rng_state' in checkpoint:
+                set_rng_state(checkpoint['rng_state'])
+            args.start_epoch = checkpoint['epoch']
+        log_t3 = '=> loaded checkpoint {} (epoch {})'.format(args.resume, checkpoint['epoch'])
+        log_print(log_t3, log_dir)
+        del checkpoint
 
     cudnn.benchmark = True
 
-    traindir = os.path.join('./data', args.data, 'train.list')
-    valdir1 = os.path.join('./data', args.data, 'test_seen.list')
-    valdir2 = os.path.join('./data', args.data, 'test_unseen.list')
+    ''' attribute table on the training device '''
+    semantic_data['att_table'] = torch.tensor(semantic_data['all_att'], device=args.device)
 
-    train_transforms, train_transforms2, val_transforms, val_transforms2 = preprocess_strategy(args.data, args)
+    traindir = store.samples('train.list')
+    valdir1 = store.samples('test_seen.list')
+    valdir2 = store.samples('test_unseen.list')
 
-    train_dataset = datasets.ImageFolder(img_path, traindir, train_transforms, train_transforms2)
+    train_transforms, train_transforms2, val_transforms, val_transforms2 = preprocess_strategy(args.data, args)
 
-    if args.distributed:
+    if args.batch_size % args.repeat_aug != 0:
+        raise ValueError('--batch-size must be divisible by --repeat-aug')
+    train_dataset = datasets.ImageFolder(img_path, traindir, train_transforms, train_transforms2,
+                                         fetch_threads=args.fetch_threads, repeats=args.repeat_aug)
+    val_dataset1 = datasets.ImageFolder(img_path, valdir1, val_transforms, val_transforms2,
+                                        fetch_threads=args.fetch_threads)
+    val_dataset2 = datasets.ImageFolder(img_path, valdir2, val_transforms, val_transforms2,
+                                        fetch_threads=args.fetch_threads)
+
+    if args.repeat_aug > 1:
+        train_sampler = datasets.RepeatAugSampler(train_dataset.targets, args.repeat_aug, seed=args.seed,
+                                                  num_replicas=args.world_size, rank=args.rank)
+    elif args.distributed:
         train_sampler = torch.utils.data.distributed.DistributedSampler(train_dataset)
     else:
         train_sampler = None
 
+    if args.distributed:
+        # every rank scores a contiguous shard, validate() gathers them back in order
+        val_sampler1 = datasets.ShardSampler(len(val_dataset1), args.world_size, args.rank)
+        val_sampler2 = datasets.ShardSampler(len(val_dataset2), args.world_size, args.rank)
+    else:
+        val_sampler1 = val_sampler2 = None
+
+    ''' loader settings '''
+    loader_config_path = args.loader_config or os.path.join(args.save_path, 'loader_config.json')
+    loader_key = autotune.config_key(args)
+    if args.autotune:
+        # trials of concurrent ranks would compete for the same cores, tune on rank 0 only
+        loader_config = [None]
+        if args.rank == 0:
+            loader_config[0] = autotune.tune(train_dataset, args.batch_size // args.repeat_aug, train_sampler,
+                                             log_dir)
+            if loader_config[0] is not None:
+                autotune.save_config(loader_config_path, loader_key, loader_config[0])
+        if args.distributed:
+            dist.broadcast_object_list(loader_config, src=0)
+        loader_config = loader_config[0]
+    else:
+        loader_config = autotune.load_config(loader_config_path, loader_key)
+    if loader_config is None:
+        loader_config = {'workers': args.workers}
+    else:
+        log_print('=> loader settings {} from {}'.format(loader_config, loader_config_path), log_dir)
+    loader_kw = autotune.loader_kwargs(loader_config)
+
+    if args.profile_pipeline:
+        pipeline_stats = PipelineStats(loader_config['workers'])
+        train_dataset.stats = pipeline_stats
+    else:
+        pipeline_stats = None
+
     train_loader = torch.utils.data.DataLoader(
-        train_dataset, batch_size=args.batch_size, shuffle=(train_sampler is None),
-        num_workers=args.workers, pin_memory=True, sampler=train_sampler, drop_last=True)
+        train_dataset, batch_size=args.batch_size // args.repeat_aug, shuffle=(train_sampler is None),
+        pin_memory=True, sampler=train_sampler, drop_last=True,
+        collate_fn=train_dataset.collate, **loader_kw)
 
     val_loader1 = torch.utils.data.DataLoader(
-        datasets.ImageFolder(img_path, valdir1, val_transforms, val_transforms2),
-        batch_size=args.batch_size, shuffle=False,
-        num_workers=args.workers, pin_memory=True, drop_last=True)
+        val_dataset1, batch_size=args.batch_size, shuffle=False, sampler=val_sampler1,
+        pin_memory=True, drop_last=False,
+        collate_fn=val_dataset1.collate, **loader_kw)
 
     val_loader2 = torch.utils.data.DataLoader(
-        datasets.ImageFolder(img_path, valdir2, val_transforms, val_transforms2),
-        batch_size=args.batch_size, shuffle=False,
-        num_workers=args.workers, pin_memory=True, drop_last=True)
+        val_dataset2, batch_size=args.batch_size, shuffle=False, sampler=val_sampler2,
+        pin_memory=True, drop_last=False,
+        collate_fn=val_dataset2.collate, **loader_kw)
+
+    if args.rank == 0:
+        # frozen parameters are written once next to the checkpoints
+        frozen = set(k for k, v in model.named_parameters() if not v.requires_grad) \
+            if args.ckpt_trainable_only else None
+        ckpt_manager = CheckpointManager(frozen=frozen)
 
     for epoch in range(args.start_epoch, args.epochs):
-        if args.distributed:
+        if train_sampler is not None:
             train_sampler.set_epoch(epoch)
         adjust_learning_rate(optimizer, odr_optimizer, zsr_optimizer, epoch, args)
 
         # train for one epoch
         train(log_dir, train_loader, semantic_data, model, criterion, optimizer, odr_optimizer, zsr_optimizer, epoch,
-              is_fix=args.is_fix)
+              is_fix=args.is_fix, stats=pipeline_stats)
+        if pipeline_stats is not None:
+            pipeline_stats.report(epoch, log_dir,
+                                  dump=os.path.join(out_dir, 'pipeline_stats.jsonl') if args.rank == 0 else None)
 
         # evaluate on validation set
-        prec1 = validate(val_loader1, val_loader2, semantic_data, model, criterion, log_dir)
+        logit_file = os.path.join(out_dir, 'logits_epoch{:03d}.npz'.format(epoch)) \
+            if args.save_logits and args.rank == 0 else None
+        prec1, gzsl_threshold = validate(val_loader1, val_loader2, semantic_data, model, criterion, log_dir,
+                                         logit_file=logit_file)
 
         # remember best prec@1 and save checkpoint
         is_best = prec1 > best_prec1
@@ -276,60 +409,75 @@ def main():
             save_path = os.path.join(args.save_path, 'fix.model')
         else:
             save_path = os.path.join(args.save_path, args.arch + ('_{:.4f}.model').format(best_prec1))
-        if is_best:
-            save_checkpoint({
+        if is_best and args.rank == 0:
+            start = time.time()
+            ckpt_manager.save({
                 'epoch': epoch + 1,
                 'arch': args.arch,
+                # plain training arguments, enough to rebuild the model for inference
+                'args': {k: v for k, v in vars(args).items() if isinstance(v, (bool, int, float, str))},
                 'state_dict': model.state_dict(),
                 'best_prec1': best_prec1,
+                # calibrated ODR confidence threshold of post_process, used for serving
+                'gzsl_threshold': gzsl_threshold,
+                'optimizer': optimizer.state_dict(),
+                'odr_optimizer': odr_optimizer.state_dict(),
+                'zsr_optimizer': zsr_optimizer.state_dict(),
+                'rng_state': get_rng_state(),
             }, filename=save_path)
-            print('saving!!!!')
+            print('saving!!!! (epoch loop blocked {:.2f}s)'.format(time.time() - start))
         log_text = 'Best_prec:{:.4f};'.format(best_prec1)
         log_print(log_text, log_dir)
 
+    if args.rank == 0:
+        ckpt_manager.close()
+
 
 def train(log_dir, train_loader, semantic_data, model, criterion, optimizer, odr_optimizer, zsr_optimizer, epoch,
-          is_fix):
+          is_fix, stats=None):
     # switch to train mode
     model.train()
     if (is_fix):
         freeze_bn(model)
 
+    # transfer, uint8 conversion and attribute gather of batch i+1 overlap batch i
+    prefetcher = BatchPrefetcher(train_loader, args.device, semantic_data['att_table'], to_float)
+
     end = time.time()
-    for i, (input, target) in enumerate(train_loader):
+    for i, (input, target, att) in enumerate(prefetcher):
         # measure data loading time
-        sf = semantic_data['all_att']
-        att = sf[target]
-        att = torch.tensor(att)
-        if args.gpu is not None:
-            input = input.cuda(args.gpu, non_blocking=True)
-        target = target.cuda(args.gpu, non_blocking=True)
-        att = att.cuda(args.gpu, non_blocking=True)
-        # compute output
-        logits, feats = model(input)
-        total_loss, L_odr, L_zsr, L_aux, L_fft = criterion(target, logits, att)
-
-        # compute gradient and do SGD step
+        if stats is not None:
+            stats.record('wait', time.time() - end)
+            start = time.time()
+        # odr_ and zsr_ parameters are disjoint, so a single backward over the summed
+        # loss gives both pretrained-stage optimizers the gradients of two separate passes
         if args.pretrained:
-            odr_optimizer.zero_grad()
-            L_odr.backward()
-            odr_optimizer.step()
-
-            zsr_optimizer.zero_grad()
-            (L_zsr + L_aux + L_fft * args.lossw).backward()
-            zsr_optimizer.step()
+            optimizers = [odr_optimizer, zsr_optimizer]
         else:
-            optimizer.zero_grad()
-            total_loss.backward()
-            optimizer.step()
+            optimizers = [optimizer]
+        for opt in optimizers:
+            opt.zero_grad()
+
+        # compute output and gradient over micro-batches
+        losses = accumulate_gradients(model, criterion, input, target, att, args.accum_steps)
+
+        for opt in optimizers:
+            opt.step()
 
         if i % args.print_freq == 0:
+            L_odr, L_zsr, L_aux, L_fft = losses.tolist()
             log_text = 'Epoch: [{}][{}/{}] loss: L_odr {:.4f} L_zsl {:.4f} L_aux {:.4f} L_fft {:.4f} ;'.format(
-                epoch, i, len(train_loader), L_odr.item(), L_zsr.item(), L_aux.item(), L_fft.item())
+                epoch, i, len(train_loader), L_odr, L_zsr, L_aux, L_fft)
             log_print(log_text, log_dir)
 
+        if stats is not None:
+            if input.is_cuda:
+                torch.cuda.synchronize()
+            stats.record('step', time.time() - start)
+        end = time.time()
+
 
-def validate(val_loader1, val_loader2, semantic_data, model, criterion, log_dir):
+def validate(val_loader1, val_loader2, semantic_data, model, criterion, log_dir, logit_file=None):
     ''' load semantic data'''
     seen_c = semantic_data['seen_class']
     unseen_c = semantic_data['unseen_class']
@@ -337,18 +485,20 @@ def validate(val_loader1, val_loader2, semantic_data, model, criterion, log_dir)
 
     # switch to evaluate mode
     model.eval()
+    if isinstance(model, torch.nn.parallel.DistributedDataParallel):
+        # shards can differ in length, keep collectives out of the forward pass
+        model = model.module
 
     if args.flippingtest:  # flipping test
         test_flip = True
     else:
         test_flip = False
 
-    with torch.no_grad():
-        end = time.time()
-        for i, (input, target) in enumerate(val_loader1):
-            if args.gpu is not None:
-                input = input.cuda(args.gpu, non_blocking=True)
-            target = target.cuda(args.gpu, non_blocking=True)
+    def run(val_loader):
+        gt, odr, zsl = [], [], []
+        for i, (input, target) in enumerate(val_loader):
+            input = input.to(args.device, non_blocking=True)
+            input = to_float(input)
 
             if test_flip:
                 [N, M, C, H, W] = input.size()
@@ -363,112 +513,35 @@ def validate(val_loader1, val_loader2, semantic_data, model, criterion, log_dir)
             else:
                 odr_logit = logits[0].cpu().numpy()
                 zsl_logit = logits[1].cpu().numpy()
-            zsl_logit_s = zsl_logit.copy();
-            zsl_logit_s[:, unseen_c] = -1
-            zsl_logit_t = zsl_logit.copy();
-            zsl_logit_t[:, seen_c] = -1
-            # evaluation
-            if (i == 0):
-                gt_s = target.cpu().numpy()
-                odr_pre_s = np.argmax(odr_logit, axis=1)
-                if test_flip:
-                    odr_prob_s = odr_logit
-                else:
-                    odr_prob_s = softmax(odr_logit)
-                zsl_pre_sA = np.argmax(zsl_logit, axis=1)
-                zsl_pre_sS = np.argmax(zsl_logit_s, axis=1)
-                if test_flip:
-                    zsl_prob_s = zsl_logit_t
-                else:
-                    zsl_prob_s = softmax(zsl_logit_t)
-            else:
-                gt_s = np.hstack([gt_s, target.cpu().numpy()])
-                odr_pre_s = np.hstack([odr_pre_s, np.argmax(odr_logit, axis=1)])
-                if test_flip:
-                    odr_prob_s = np.vstack([odr_prob_s, odr_logit])
-                else:
-                    odr_prob_s = np.vstack([odr_prob_s, softmax(odr_logit)])
-                zsl_pre_sA = np.hstack([zsl_pre_sA, np.argmax(zsl_logit, axis=1)])
-                zsl_pre_sS = np.hstack([zsl_pre_sS, np.argmax(zsl_logit_s, axis=1)])
-                if test_flip:
-                    zsl_prob_s = np.vstack([zsl_prob_s, zsl_logit_t])
-                else:
-                    zsl_prob_s = np.vstack([zsl_prob_s, softmax(zsl_logit_t)])
-
-        for i, (input, target) in enumerate(val_loader2):
-            if args.gpu is not None:
-                input = input.cuda(args.gpu, non_blocking=True)
-            target = target.cuda(args.gpu, non_blocking=True)
+            gt.append(target.numpy())
+            odr.append(odr_logit)
+            zsl.append(zsl_logit)
+        return np.hstack(gt), np.vstack(odr), np.vstack(zsl)
 
-            if test_flip:
-                [N, M, C, H, W] = input.size()
-                input = input.view(N * M, C, H, W)  # flipping test
+    with torch.no_grad():
+        gt_s, odr_s, zsl_s = run(val_loader1)
+        gt_t, odr_t, zsl_t = run(val_loader2)
 
-            # inference
-            logits, feats = model(input)
+        if args.distributed:
+            # gather the per-rank shards in rank order before scoring
+            gt_s, odr_s, zsl_s, gt_t, odr_t, zsl_t = all_gather_arrays(gt_s, odr_s, zsl_s, gt_t, odr_t, zsl_t)
 
-            if test_flip:
-                odr_logit = F.softmax(logits[0], dim=1).view(N, M, -1).mean(dim=1).cpu().numpy()
-                zsl_logit = F.softmax(logits[1], dim=1).view(N, M, -1).mean(dim=1).cpu().numpy()
-            else:
-                odr_logit = logits[0].cpu().numpy()
-                zsl_logit = logits[1].cpu().numpy()
-            zsl_logit_s = zsl_logit.copy();
-            zsl_logit_s[:, unseen_c] = -1
-            zsl_logit_t = zsl_logit.copy();
-            zsl_logit_t[:, seen_c] = -1
-
-            if (i == 0):
-                gt_t = target.cpu().numpy()
-                odr_pre_t = np.argmax(odr_logit, axis=1)
-                if test_flip:
-                    odr_prob_t = odr_logit
-                else:
-                    odr_prob_t = softmax(odr_logit)
-                zsl_pre_tA = np.argmax(zsl_logit, axis=1)
-                zsl_pre_tT = np.argmax(zsl_logit_t, axis=1)
-                if test_flip:
-                    zsl_prob_t = zsl_logit_t
-                else:
-                    zsl_prob_t = softmax(zsl_logit_t)
-            else:
-                gt_t = np.hstack([gt_t, target.cpu().numpy()])
-                odr_pre_t = np.hstack([odr_pre_t, np.argmax(odr_logit, axis=1)])
-                if test_flip:
-                    odr_prob_t = np.vstack([odr_prob_t, odr_logit])
-                else:
-                    odr_prob_t = np.vstack([odr_prob_t, softmax(odr_logit)])
-                zsl_pre_tA = np.hstack([zsl_pre_tA, np.argmax(zsl_logit, axis=1)])
-                zsl_pre_tT = np.hstack([zsl_pre_tT, np.argmax(zsl_logit_t, axis=1)])
-                if test_flip:
-                    zsl_prob_t = np.vstack([zsl_prob_t, zsl_logit_t])
-                else:
-                    zsl_prob_t = np.vstack([zsl_prob_t, softmax(zsl_logit_t)])
-
-        odr_prob = np.vstack([odr_prob_s, odr_prob_t])
-        zsl_prob = np.vstack([zsl_prob_s, zsl_prob_t])
-        gt = np.hstack([gt_s, gt_t])
-
-        SS = compute_class_accuracy_total(gt_s, zsl_pre_sS, seen_c)
-        UU = compute_class_accuracy_total(gt_t, zsl_pre_tT, unseen_c)
-        ST = compute_class_accuracy_total(gt_s, zsl_pre_sA, seen_c)
-        UT = compute_class_accuracy_total(gt_t, zsl_pre_tA, unseen_c)
-        H = 2 * ST * UT / (ST + UT)
-        CLS = compute_class_accuracy_total(gt_s, odr_pre_s, seen_c)
-
-        H_opt, S_opt, U_opt, Ds_opt, Du_opt, tau = post_process(odr_prob, zsl_prob, gt, gt_s.shape[0], seen_c, unseen_c,
-                                                                args.data)
-
-        
-        log_text2 = 'SS: {:.4f} UU: {:.4f} ST: {:.4f} UT: {:.4f} H: {:.4f}'.format(SS, UU, ST, UT, H)
+        if logit_file is not None:
+            # raw outputs for offline re-scoring with rescore.py
+            save_logits(logit_file, odr_s, zsl_s, gt_s, odr_t, zsl_t, gt_t, seen_c, unseen_c, probs=test_flip,
+                        data=args.data)
+
+        scores = gzsl_scores(odr_s, zsl_s, gt_s, odr_t, zsl_t, gt_t, seen_c, unseen_c, args.data, probs=test_flip)
+
+        log_text2 = 'SS: {SS:.4f} UU: {UU:.4f} ST: {ST:.4f} UT: {UT:.4f} H: {H:.4f}'.format(**scores)
         log_print(log_text2, log_dir)
-        log_text3 = 'CLS {:.4f} S_opt: {:.4f} U_opt {:.4f} H_opt {:.4f} Ds_opt {:.4f} Du_opt {:.4f} tau {:.4f}'.format(
-            CLS, S_opt, U_opt, H_opt, Ds_opt, Du_opt, tau)
+        log_text3 = 'CLS {CLS:.4f} S_opt: {S_opt:.4f} U_opt {U_opt:.4f} H_opt {H_opt:.4f} Ds_opt {Ds_opt:.4f} ' \
+                    'Du_opt {Du_opt:.4f} tau {tau:.4f}'.format(**scores)
         log_print(log_text3, log_dir)
 
-        H = max(H, H_opt)
+        H = max(scores['H'], scores['H_opt'])
 
-    return H
+    return H, scores['base']
 
 
 if __name__ == '__main__':
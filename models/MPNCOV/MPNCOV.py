@@ -131,7 +131,7 @@ class Triuvec(Function):
          grad_input = torch.zeros(batchSize,dim,dim,device = x.device,requires_grad=False)
          grad_input = grad_input.reshape(batchSize,dim*dim)
          for i in range(batchSize):
-            grad_input[i,index] = grad_output[i,:].reshape(index.size(),1)
+            grad_input[i,index.view(-1)] = grad_output[i,:]
          grad_input = grad_input.reshape(batchSize,dim,dim)
          return grad_input
 
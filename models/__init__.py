@@ -1 +1,20 @@
-from models.dvbe import *
\ No newline at end of file
+"""Model registry.
+
+Architectures are registered by the module that defines their constructor. The
+module is only imported when the model is requested, so listing ``model_names``
+(e.g. for the ``--arch`` choices) imports neither torch nor any model code.
+"""
+import importlib
+
+_registry = {
+    'fpa': 'models.fpa',
+}
+
+model_names = sorted(_registry)
+
+
+def get_model(name):
+    """Returns the constructor registered as ``name``, importing its module on first use."""
+    if name not in _registry:
+        raise KeyError('unknown model {!r}, choose from {}'.format(name, ', '.join(model_names)))
+    return getattr(importlib.import_module(_registry[name]), name)
@@ -1,18 +1,14 @@
 import torch.nn as nn
 import math
-import torch.utils.model_zoo as model_zoo
 import torch
 from models.MPNCOV import MPNCOV
 import torch.nn.functional as F
-import models.resnet
-import models.densenet
-import models.senet
-from models.operations import *
 import torch.fft
+from torch.utils.checkpoint import checkpoint as grad_checkpoint
 import random
+import contextlib
+from checkpointing import materialize
 
-import re
-from torch.utils.model_zoo import load_url as load_state_dict_from_url
 
 __all__ = ['fpa']
 
@@ -100,10 +96,13 @@ class Bottleneck(nn.Module):
         return out
 
 
-def GlobalFilter(x, b, w):
+def GlobalFilter(x, b, w, idx=None):
+    if idx is None:
+        idx = random.randint(0, b - 1)
     fft_pre1 = torch.fft.fft2(x, dim=(-2, -1), norm='ortho')
+    fre_m = torch.abs(fft_pre1)
     fre_p = torch.angle(fft_pre1)
-    fre_p_random = fre_p[random.randint(0, b - 1)]
+    fre_p_random = fre_p[idx]
     fre_p = fre_p *(1-w) + fre_p_random * w
     fre_ = fre_m * torch.exp(1j * fre_p)
 
@@ -135,6 +134,54 @@ class FreqAttention(nn.Module):
 
         return out
 
+
+CHECKPOINT_STAGES = ['layer1', 'layer2', 'layer3', 'layer4', 'odr', 'fft']
+
+
+def parse_checkpoint_segments(spec):
+    """Parses ``--checkpoint-segments``, e.g. ``layer3:6,layer4,odr``.
+
+    Returns:
+        dict: stage name -> number of checkpoint segments (1 if not given).
+    """
+    segments = {}
+    for item in filter(None, (spec or '').split(',')):
+        name, _, n = item.partition(':')
+        if name not in CHECKPOINT_STAGES:
+            raise ValueError('unknown checkpoint stage {}, expected one of {}'.format(name, CHECKPOINT_STAGES))
+        segments[name] = int(n) if n else 1
+    return segments
+
+
+@contextlib.contextmanager
+def bn_stats_frozen(module):
+    """Stops BatchNorm layers in ``module`` from updating their running statistics."""
+    saved = [(m, m.momentum, m.num_batches_tracked.clone()) for m in module.modules()
+             if isinstance(m, nn.BatchNorm2d) and m.training and m.track_running_stats]
+    for m, _, _ in saved:
+        m.momentum = 0.
+    try:
+        yield
+    finally:
+        for m, momentum, tracked in saved:
+            m.momentum = momentum
+            m.num_batches_tracked.copy_(tracked)
+
+
+def init_weights(m):
+    if isinstance(m, nn.Conv2d):
+        nn.init.kaiming_normal_(m.weight, mode='fan_out', nonlinearity='relu')
+    elif isinstance(m, nn.BatchNorm2d):
+        nn.init.constant_(m.weight, 1)
+        nn.init.constant_(m.bias, 0)
+
+
+def init_module(m):
+    """Initializes a module materialized from the meta device as Model.__init__ would."""
+    m.reset_parameters()
+    init_weights(m)
+
+
 class Model(nn.Module):
     def __init__(self, pretrained=True, args=None):
         self.inplanes = 64
@@ -143,8 +190,10 @@ class Model(nn.Module):
         sf_size = args.sf_size
         self.arch = args.backbone
         self.adj = args.adj
-        self.sf = torch.from_numpy(args.sf).cuda()
         super(Model, self).__init__()
+        # follows the model across devices, not part of the state dict; created on the CPU
+        # even when the model is built on the meta device, so that materialize keeps it
+        self.register_buffer('sf', torch.tensor(args.sf, device='cpu'), persistent=False)
 
         ''' backbone net'''
         block = Bottleneck
@@ -160,6 +209,7 @@ class Model(nn.Module):
         self.layer4 = self._make_layer(block, 512, layers[3], stride=1)
         self.b = args.batch_size
         self.w = args.phasew
+        self.checkpoint_segments = parse_checkpoint_segments(getattr(args, 'checkpoint_segments', ''))
 
         self.match_channels_x2 = nn.Conv2d(512, 2048, kernel_size=1)
         self.match_channels_x3 = nn.Conv2d(1024, 2048, kernel_size=1)
@@ -241,11 +291,7 @@ class Model(nn.Module):
 
         ''' params ini '''
         for m in self.modules():
-            if isinstance(m, nn.Conv2d):
-                nn.init.kaiming_normal_(m.weight, mode='fan_out', nonlinearity='relu')
-            elif isinstance(m, nn.BatchNorm2d):
-                nn.init.constant_(m.weight, 1)
-                nn.init.constant_(m.bias, 0)
+            init_weights(m)
 
     def _make_layer(self, block, planes, blocks, stride=1):
         downsample = None
@@ -264,28 +310,32 @@ class Model(nn.Module):
 
         return nn.Sequential(*layers)
 
-    def forward(self, x):
-        # backbone
-        x = self.conv1(x)
-        x = self.bn1(x)
-        x = self.relu(x)
-        x = self.maxpool(x)
-
-        x1 = self.layer1(x)
-        x2 = self.layer2(x1)
-        x3 = self.layer3(x2)
-        x4 = self.layer4(x3)
-
-        x2_upsampled = F.interpolate(x2, size=x4.size()[2:], mode='bilinear', align_corners=True)
-        x3_upsampled = F.interpolate(x3, size=x4.size()[2:], mode='bilinear', align_corners=True)
-        x2_matched = self.match_channels_x2(x2_upsampled)
-        x3_matched = self.match_channels_x3(x3_upsampled)
-
-        x = x2_matched + x3_matched + x4
-
-        last_conv = x
-
-        ''' ODR Module '''
+    def _checkpointed(self, name):
+        return name in self.checkpoint_segments and self.training and torch.is_grad_enabled()
+
+    def _checkpoint(self, module, fn, *inputs):
+        # the recomputation in backward must not update BN running statistics twice
+        return grad_checkpoint(fn, *inputs, use_reentrant=False,
+                               context_fn=lambda: (contextlib.nullcontext(), bn_stats_frozen(module)))
+
+    def _run_stage(self, name, x):
+        stage = getattr(self, name)
+        if not self._checkpointed(name):
+            return stage(x)
+        blocks = list(stage.children())
+        segments = min(self.checkpoint_segments[name], len(blocks))
+        size = int(math.ceil(len(blocks) / float(segments)))
+        for start in range(0, len(blocks), size):
+            segment = nn.Sequential(*blocks[start:start + size])
+            x = self._checkpoint(segment, segment, x)
+        return x
+
+    def _run_head(self, name, fn, *inputs):
+        if not self._checkpointed(name):
+            return fn(*inputs)
+        return self._checkpoint(self, fn, *inputs)
+
+    def _odr_head(self, last_conv):
         x1 = self.odr_proj1(last_conv)
         x2 = x1
 
@@ -307,7 +357,9 @@ class Model(nn.Module):
 
         odr_x = x.view(x.size(0), -1)
         odr_logit = self.odr_classifier(odr_x)
+        return odr_x, odr_logit
 
+    def _fft_head(self, last_conv, idx):
         weights = torch.softmax(self.cov(last_conv), dim=1)
         w = last_conv.size()
         batch, parts, width, height = weights.size()
@@ -318,7 +370,7 @@ class Model(nn.Module):
             .expand(batch, parts)
         weights = weights * local_max.ge(threshold_value).view(batch, parts, 1, 1). \
             float().expand(batch, parts, width, height)
-        last_conv = GlobalFilter(last_conv, self.b, self.w)
+        last_conv = GlobalFilter(last_conv, last_conv.size(0), self.w, idx)
 
         for k in range(self.parts):
             Y = last_conv * weights[:, k, :, :]. \
@@ -327,6 +379,36 @@ class Model(nn.Module):
 
         Y = Y + last_conv
         fft_last = self.fft_proj(Y).view(Y.size(0), -1)
+        return fft_last, last_conv
+
+    def forward(self, x):
+        # backbone
+        x = self.conv1(x)
+        x = self.bn1(x)
+        x = self.relu(x)
+        x = self.maxpool(x)
+
+        x1 = self._run_stage('layer1', x)
+        x2 = self._run_stage('layer2', x1)
+        x3 = self._run_stage('layer3', x2)
+        x4 = self._run_stage('layer4', x3)
+
+        x2_upsampled = F.interpolate(x2, size=x4.size()[2:], mode='bilinear', align_corners=True)
+        x3_upsampled = F.interpolate(x3, size=x4.size()[2:], mode='bilinear', align_corners=True)
+        x2_matched = self.match_channels_x2(x2_upsampled)
+        x3_matched = self.match_channels_x3(x3_upsampled)
+
+        x = x2_matched + x3_matched + x4
+
+        last_conv = x
+
+        ''' ODR Module '''
+        odr_x, odr_logit = self._run_head('odr', self._odr_head, last_conv)
+
+        # mix phases within the actual (micro-)batch, which can be smaller than --batch-size;
+        # the partner is drawn here so that a checkpointed recomputation reuses it
+        idx = random.randint(0, last_conv.size(0) - 1)
+        fft_last, last_conv = self._run_head('fft', self._fft_head, last_conv, idx)
         fft_att = self.fft2(fft_last)
         ''' ZSR Module '''
         x_all =  fft_last
@@ -387,21 +469,29 @@ class Loss(nn.Module):
         return total_loss, L_odr, L_zsr, L_aux, L_fft
 
 
-def fpa(pretrained=False, loss_params=None, args=None):
+def fpa(pretrained=False, loss_params=None, args=None, state_dict=None, device='cpu'):
     """Constructs a ResNet-101 model.
 
+    The model is built on the meta device and allocated once on ``device``; only the
+    parameters no checkpoint provides are initialized.
+
     Args:
         pretrained (bool): If True, returns a model pre-trained on ImageNet
+        state_dict (dict, optional): Full model weights, e.g. of a checkpoint to resume.
+            Every key must match; the ImageNet weights are not read in that case.
+        device: Device the parameters are allocated on.
     """
-    model = Model(pretrained, args)
+    with torch.device('meta'):
+        model = Model(pretrained, args)
     loss_model = Loss(args)
-    if pretrained:
-        model_dict = model.state_dict()
+    if state_dict is not None:
+        materialize(model, device, state_dict, init_module, strict=True)
+    elif pretrained:
         # pretrained_dict = model_zoo.load_url(model_urls['resnet101'])
-        pretrained_dict = torch.load('/home/ywt/raw_data/model/resnet101-5d3b4d8f.pth')
-        pretrained_dict = {k: v for k, v in pretrained_dict.items() if k in model_dict}
-        model_dict.update(pretrained_dict)
-        model.load_state_dict(model_dict)
+        # memory-mapped: tensors are copied from the file straight into the parameters
+        materialize(model, device, '/home/ywt/raw_data/model/resnet101-5d3b4d8f.pth', init_module)
+    else:
+        materialize(model, device, None, init_module)
     return model, loss_model
 
 
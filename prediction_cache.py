@@ -0,0 +1,128 @@
+import collections
+import hashlib
+import os
+import shutil
+import threading
+
+import numpy as np
+
+# namespaces live in this subdirectory of ``disk_dir``; only directories holding
+# the marker file were created by the cache and may be deleted by it
+NAMESPACE_DIR = 'prediction_cache'
+MARKER = '.prediction_cache'
+
+
+def content_key(data):
+    """Hash of the encoded image bytes."""
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+class PredictionCache(object):
+    """Model outputs of already seen images, keyed by a hash of their bytes.
+
+    Entries live in an in-memory LRU of ``capacity`` images and, with ``disk_dir``,
+    also as ``.npy`` files below ``<disk_dir>/prediction_cache/<fingerprint>``, which
+    survive restarts. All entries belong to the checkpoint ``fingerprint``;
+    ``invalidate`` switches to a new checkpoint, which empties the memory tier and
+    starts a fresh disk namespace; ``remove_stale`` deletes the old ones. Values are
+    whatever the caller stores, e.g. the raw logits, so that thresholds can change
+    without invalidating the cache. Safe to use from several threads.
+
+    Args:
+        fingerprint (string): Identifies the model, e.g. ``checkpointing.fingerprint``.
+        capacity (int): Images kept in memory.
+        disk_dir (string, optional): Directory of the on-disk tier.
+    """
+
+    def __init__(self, fingerprint, capacity=10000, disk_dir=None):
+        self.capacity = capacity
+        self.disk_dir = disk_dir
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidate(fingerprint)
+        self.remove_stale()
+
+    def invalidate(self, fingerprint):
+        """Drops all entries of the previous model and starts the namespace of ``fingerprint``.
+
+        Only the directory switch happens here; the stale namespaces are left to
+        ``remove_stale``, which can take long and so can run off the caller's thread.
+        """
+        if fingerprint == getattr(self, 'fingerprint', None):
+            return
+        with self._lock:
+            self.fingerprint = fingerprint
+            self._entries.clear()
+        if self.disk_dir is not None:
+            namespace = os.path.join(self.disk_dir, NAMESPACE_DIR, fingerprint)
+            os.makedirs(namespace, exist_ok=True)
+            open(os.path.join(namespace, MARKER), 'a').close()
+
+    def remove_stale(self):
+        """Deletes the disk namespaces of all checkpoints but the current one."""
+        if self.disk_dir is None:
+            return
+        root = os.path.join(self.disk_dir, NAMESPACE_DIR)
+        for name in os.listdir(root):
+            path = os.path.join(root, name)
+            # re-read per namespace: a concurrent invalidate may have switched to it
+            if name != self.fingerprint and os.path.isfile(os.path.join(path, MARKER)):
+                shutil.rmtree(path, ignore_errors=True)
+
+    def _path(self, key):
+        return os.path.join(self.disk_dir, NAMESPACE_DIR, self.fingerprint, key[:2], key + '.npy')
+
+    def get(self, key):
+        """Returns the cached value of ``key`` or None."""
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+        if self.disk_dir is not None:
+            try:
+                value = tuple(np.load(self._path(key)))
+            except (IOError, OSError, ValueError):
+                value = None
+            if value is not None:
+                self._remember(key, value)
+                with self._lock:
+                    self.disk_hits += 1
+                return value
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def _remember(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def put(self, key, value):
+        """Stores ``value``, a tuple of equally shaped arrays, under ``key``."""
+        self._remember(key, value)
+        if self.disk_dir is not None:
+            path = self._path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = '{}.{}.tmp.npy'.format(path[:-len('.npy')], threading.get_ident())
+            np.save(tmp, np.stack(value))
+            os.replace(tmp, path)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses,
+                    'hit_rate': (self.hits + self.disk_hits) / max(1, lookups), 'evictions': self.evictions,
+                    'entries': len(self._entries), 'capacity': self.capacity,
+                    'fingerprint': self.fingerprint}
@@ -0,0 +1,217 @@
+import argparse
+import math
+import time
+
+import torch
+import torch.nn.functional as F
+
+
+def _as_tensor(x, device=None, dtype=torch.float32):
+    return torch.as_tensor(x, dtype=dtype, device=device)
+
+
+def merge_topk(scores, ids, k):
+    """Keeps the ``k`` best of already collected candidate ``scores`` / ``ids`` (B x M)."""
+    k = min(k, scores.size(1))
+    scores, pos = scores.topk(k, dim=1)
+    return scores, ids.gather(1, pos)
+
+
+def recall(exact_ids, approx_ids):
+    """Fraction of the exact top-k ids that an approximate search also returned."""
+    exact_ids, approx_ids = exact_ids.cpu(), approx_ids.cpu()
+    hits = (exact_ids.unsqueeze(2) == approx_ids.unsqueeze(1)).any(dim=2)
+    return hits.float().mean().item()
+
+
+class PrototypeIndex(object):
+    """Exact top-k scoring of queries against class prototypes by inner product.
+
+    Scores are computed chunk by chunk over the classes and the queries, so at most
+    ``query_chunk x (class_chunk + k)`` scores are held at once no matter how many
+    classes the vocabulary has. The ZSR head scores cosine similarity, build the
+    index with ``from_model`` (normalized ``zsr_sem(sf)``) and pass normalized
+    features; the FFT head scores ``fft_att`` against the raw attributes, see
+    ``attribute_space``.
+
+    Args:
+        prototypes (Tensor): Class x dim prototype matrix.
+        ids (Tensor, optional): Class id of every row, ``arange(C)`` by default.
+            Build an index over ``sf[unseen_class]`` with ``ids=unseen_class`` to
+            search a subset of the vocabulary.
+        normalize (bool): L2-normalize the prototypes and every query (cosine).
+        class_chunk (int): Classes scored per step.
+        query_chunk (int): Queries scored per step.
+    """
+
+    def __init__(self, prototypes, ids=None, normalize=False, class_chunk=8192, query_chunk=1024,
+                 device=None):
+        prototypes = _as_tensor(prototypes, device)
+        if normalize:
+            prototypes = F.normalize(prototypes, p=2, dim=1)
+        self.prototypes = prototypes
+        self.ids = (torch.arange(prototypes.size(0), device=prototypes.device) if ids is None
+                    else _as_tensor(ids, prototypes.device, torch.long))
+        self.normalize = normalize
+        self.class_chunk = class_chunk
+        self.query_chunk = query_chunk
+
+    @classmethod
+    @torch.no_grad()
+    def from_model(cls, model, ids=None, **kwargs):
+        """Index of the ZSR prototypes ``normalize(zsr_sem(sf))`` of an fpa model."""
+        model = getattr(model, 'module', model)
+        sf = model.sf if ids is None else model.sf[_as_tensor(ids, model.sf.device, torch.long)]
+        return cls(model.zsr_sem(sf), ids=ids, normalize=True, **kwargs)
+
+    @classmethod
+    def attribute_space(cls, sf, ids=None, **kwargs):
+        """Index scoring predicted attributes (``fft_att``) against class attributes ``sf``."""
+        return cls(sf, ids=ids, normalize=False, **kwargs)
+
+    def __len__(self):
+        return self.prototypes.size(0)
+
+    def _queries(self, queries):
+        queries = _as_tensor(queries, self.prototypes.device)
+        return F.normalize(queries, p=2, dim=1) if self.normalize else queries
+
+    @torch.no_grad()
+    def search(self, queries, k=5):
+        """Returns ``(scores, ids)``, both B x min(k, C), best first."""
+        queries = self._queries(queries)
+        out_scores, out_ids = [], []
+        for q in queries.split(self.query_chunk):
+            best_scores = q.new_empty(q.size(0), 0)
+            best_ids = self.ids.new_empty(q.size(0), 0)
+            for start in range(0, len(self), self.class_chunk):
+                scores = q.mm(self.prototypes[start:start + self.class_chunk].t())
+                ids = self.ids[start:start + self.class_chunk].expand(q.size(0), -1)
+                scores, ids = merge_topk(scores, ids, k)
+                best_scores, best_ids = merge_topk(torch.cat([best_scores, scores], 1),
+                                                   torch.cat([best_ids, ids], 1), k)
+            out_scores.append(best_scores)
+            out_ids.append(best_ids)
+        return torch.cat(out_scores), torch.cat(out_ids)
+
+
+def kmeans(x, n_clusters, iters=20, spherical=True, seed=0):
+    """Lloyd's k-means on the rows of ``x``; spherical (cosine) by default.
+
+    Returns:
+        tuple: (centroids n_clusters x dim, assignment of every row)
+    """
+    g = torch.Generator(device='cpu').manual_seed(seed)
+    centroids = x[torch.randperm(x.size(0), generator=g)[:n_clusters].to(x.device)].clone()
+    for _ in range(iters):
+        if spherical:
+            assign = x.mm(centroids.t()).argmax(1)
+        else:
+            assign = torch.cdist(x, centroids).argmin(1)
+        sums = torch.zeros_like(centroids).index_add_(0, assign, x)
+        counts = torch.bincount(assign, minlength=n_clusters).unsqueeze(1)
+        # empty clusters keep their previous centroid
+        centroids = torch.where(counts > 0, sums / counts.clamp(min=1), centroids)
+        if spherical:
+            centroids = F.normalize(centroids, p=2, dim=1)
+    return centroids, assign
+
+
+class IVFIndex(PrototypeIndex):
+    """Approximate top-k with an inverted file over k-means clusters of the prototypes.
+
+    A query is scored against the ``nlist`` centroids and only the prototypes of
+    the ``nprobe`` closest lists are scored exactly, so the cost per query is about
+    ``nlist + nprobe * C / nlist`` dot products instead of ``C``. Each list is one
+    contiguous block of the cluster-sorted prototypes and is scored with a single
+    matmul against all queries probing it. Lists can be stored in float16 to halve
+    their memory. Queries whose probed lists hold fewer than ``k`` classes get
+    results padded with score ``-inf`` and id ``-1``.
+
+    Args:
+        nlist (int, optional): Number of lists, ``sqrt(C)`` by default.
+        nprobe (int): Lists scanned per query; more lists trade speed for recall.
+        half (bool): Store the lists in float16.
+        See ``PrototypeIndex`` for the other arguments.
+    """
+
+    def __init__(self, prototypes, ids=None, normalize=False, nlist=None, nprobe=8, half=False,
+                 iters=20, query_chunk=1024, device=None):
+        super(IVFIndex, self).__init__(prototypes, ids, normalize, query_chunk=query_chunk, device=device)
+        nlist = nlist or max(1, int(round(math.sqrt(len(self)))))
+        self.nprobe = min(nprobe, nlist)
+        self.centroids, assign = kmeans(self.prototypes, nlist, iters, spherical=True)
+        order = assign.argsort()
+        self.offsets = torch.cat([assign.new_zeros(1), torch.bincount(assign, minlength=nlist).cumsum(0)]).tolist()
+        self.lists = self.prototypes[order].to(torch.float16 if half else self.prototypes.dtype)
+        self.list_ids = self.ids[order]
+
+    @torch.no_grad()
+    def search(self, queries, k=5):
+        queries = self._queries(queries)
+        out_scores, out_ids = [], []
+        for q in queries.split(self.query_chunk):
+            probe = q.mm(self.centroids.t()).topk(self.nprobe, dim=1)[1]
+            # the best k of every probed list, slot j holds the j-th probed list of a query
+            scores = q.new_full((q.size(0), self.nprobe, k), float('-inf'))
+            ids = probe.new_full((q.size(0), self.nprobe, k), -1)
+            order = probe.flatten().argsort()
+            rows, slots = order // self.nprobe, order % self.nprobe
+            lists, counts = probe.flatten()[order].unique_consecutive(return_counts=True)
+            start = 0
+            for l, n in zip(lists.tolist(), counts.tolist()):
+                r, j = rows[start:start + n], slots[start:start + n]
+                start += n
+                lo, hi = self.offsets[l], self.offsets[l + 1]
+                if hi == lo:
+                    continue
+                s, pos = q[r].to(self.lists.dtype).mm(self.lists[lo:hi].t()).float().topk(min(k, hi - lo), dim=1)
+                scores[r, j, :s.size(1)] = s
+                ids[r, j, :s.size(1)] = self.list_ids[lo:hi][pos]
+            scores, ids = merge_topk(scores.flatten(1), ids.flatten(1), k)
+            out_scores.append(scores)
+            out_ids.append(ids)
+        return torch.cat(out_scores), torch.cat(out_ids)
+
+
+def synthetic(num_classes, dim, num_queries, noise=1.0, seed=0):
+    """Clustered prototypes and queries drawn near random prototypes."""
+    g = torch.Generator().manual_seed(seed)
+    groups = torch.randn(max(1, num_classes // 50), dim, generator=g)
+    prototypes = groups[torch.randint(groups.size(0), (num_classes,), generator=g)]
+    prototypes = prototypes + 0.7 * torch.randn(num_classes, dim, generator=g)
+    targets = torch.randint(num_classes, (num_queries,), generator=g)
+    queries = prototypes[targets] + noise * torch.randn(num_queries, dim, generator=g)
+    return prototypes, queries
+
+
+def benchmark(class_counts, dim=2048, num_queries=1024, k=5, nprobe=8, half=False, noise=1.0, device='cpu'):
+    """Queries/sec of exact and IVF search and IVF recall@k for every vocabulary size."""
+    print('{:>8} {:>12} {:>12} {:>10} {:>8}'.format('classes', 'exact q/s', 'ivf q/s', 'recall@' + str(k), 'nlist'))
+    for num_classes in class_counts:
+        prototypes, queries = synthetic(num_classes, dim, num_queries, noise)
+        exact = PrototypeIndex(prototypes, normalize=True, device=device)
+        ivf = IVFIndex(prototypes, normalize=True, nprobe=nprobe, half=half, device=device)
+        rates = []
+        for index in (exact, ivf):
+            index.search(queries[:8], k)
+            start = time.time()
+            _, ids = index.search(queries, k)
+            rates.append((num_queries / (time.time() - start), ids))
+        print('{:8d} {:12.0f} {:12.0f} {:10.3f} {:8d}'.format(
+            num_classes, rates[0][0], rates[1][0], recall(rates[0][1], rates[1][1]), ivf.centroids.size(0)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='prototype index benchmark on synthetic vocabularies')
+    parser.add_argument('--classes', default='200,1000,10000,50000', help='comma-separated class counts')
+    parser.add_argument('--dim', default=2048, type=int, help='prototype dimension')
+    parser.add_argument('--queries', default=1024, type=int, help='number of queries')
+    parser.add_argument('-k', default=5, type=int, help='top-k')
+    parser.add_argument('--nprobe', default=8, type=int, help='IVF lists scanned per query')
+    parser.add_argument('--half', action='store_true', help='store IVF lists in float16')
+    parser.add_argument('--noise', default=1.0, type=float, help='query noise, higher is harder')
+    parser.add_argument('--device', default='cpu', help='device to benchmark on')
+    args = parser.parse_args()
+    benchmark([int(c) for c in args.classes.split(',')], args.dim, args.queries, args.k, args.nprobe,
+              args.half, args.noise, args.device)
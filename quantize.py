@@ -0,0 +1,185 @@
+"""int8 variants of a trained model for CPU inference, with an accuracy and latency report.
+
+    python quantize.py --resume cub.model --mode dynamic
+    python quantize.py --resume cub.model --mode static --calib-list train.list --calib-batches 32
+
+``dynamic`` stores the weights of all Linear layers (``odr_classifier``,
+``zsr_sem``, ``zsr_aux``, ``fft2``) as int8 and quantizes their inputs on the
+fly. ``static`` additionally runs the ResNet trunk (stem and layer1-4) as int8
+convolutions, with activation ranges calibrated on ``--calib-list``. Both are
+compared to the float model on the two test splits (H/S/U as in ``validate``),
+in CPU latency and in serialized size.
+"""
+import argparse
+import copy
+import contextlib
+import io
+import itertools
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.utils.data as data
+from PIL import Image
+
+TRUNK = ['layer1', 'layer2', 'layer3', 'layer4']
+
+
+def quantize_dynamic(model):
+    """Copy of ``model`` with int8 weights and dynamically quantized inputs in every Linear layer."""
+    from torch.ao.quantization import quantize_dynamic as dynamic
+    return dynamic(copy.deepcopy(model), {nn.Linear}, dtype=torch.qint8)
+
+
+def quantize_static(model, calib_batches, backend='x86'):
+    """Copy of ``model`` with a statically quantized ResNet trunk and dynamic int8 Linear layers.
+
+    The stem (conv1, bn1, relu) and every stage in ``TRUNK`` become FX-quantized
+    modules that take and return float tensors, so the rest of the model (the
+    ODR and FFT heads) runs unchanged. Activation ranges are observed while
+    ``calib_batches``, an iterable of float (normalized) image batches, runs
+    through the model.
+    """
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+    torch.backends.quantized.engine = backend
+    model = copy.deepcopy(model)
+    # conv1 -> bn1 -> relu is only used by the stem, fold it into one module
+    model.conv1 = nn.Sequential(model.conv1, model.bn1, nn.ReLU())
+    model.bn1, model.relu = nn.Identity(), nn.Identity()
+    model.eval()
+    stages = ['conv1'] + TRUNK
+
+    # example inputs for tracing, as seen by every stage
+    calib_batches = iter(calib_batches)
+    first = next(calib_batches)
+    inputs = {}
+    hooks = [getattr(model, name).register_forward_pre_hook(
+        lambda m, args, name=name: inputs.setdefault(name, args[0][:1])) for name in stages]
+    with torch.no_grad():
+        model(first[:1])
+    for h in hooks:
+        h.remove()
+
+    mapping = get_default_qconfig_mapping(backend)
+    for name in stages:
+        setattr(model, name, prepare_fx(getattr(model, name), mapping, (inputs[name],)))
+    with torch.no_grad():
+        for batch in itertools.chain([first], calib_batches):
+            model(batch)
+    for name in stages:
+        setattr(model, name, convert_fx(getattr(model, name)))
+    return quantize_dynamic(model)
+
+
+def serialized_mb(model):
+    buf = io.BytesIO()
+    torch.save(model.state_dict(), buf)
+    return buf.tell() / 2 ** 20
+
+
+@torch.no_grad()
+def latency_ms(model, batch, repeats):
+    """Median forward time of ``batch`` in ms."""
+    model(batch)
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        model(batch)
+        times.append(time.perf_counter() - start)
+    return 1e3 * float(np.median(times))
+
+
+@torch.no_grad()
+def evaluate(model, loaders, to_float, store, data_name):
+    """H/S/U of ``utils.gzsl_scores`` on the seen and unseen test loaders, and the ODR/ZSR logits."""
+    from utils import gzsl_scores
+    outputs = []
+    for loader in loaders:
+        gt, odr, zsl = [], [], []
+        for images, indices, _ in loader:
+            logits, _ = model(to_float(images))
+            gt.append(np.asarray([loader.dataset.samples[i][1] for i in indices]))
+            odr.append(logits[0].float().numpy())
+            zsl.append(logits[1].float().numpy())
+        outputs.append((np.vstack(odr), np.vstack(zsl), np.hstack(gt)))
+    (odr_s, zsl_s, gt_s), (odr_t, zsl_t, gt_t) = outputs
+    # keep the per-threshold lines of post_process out of the report
+    with contextlib.redirect_stdout(io.StringIO()):
+        scores = gzsl_scores(odr_s, zsl_s, gt_s, odr_t, zsl_t, gt_t, store.array('seen_class'),
+                             store.array('unseen_class'), data_name)
+    return scores, np.vstack([odr_s, odr_t]), np.vstack([zsl_s, zsl_t])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='int8 quantization of a trained fpa model for CPU inference')
+    parser.add_argument('--resume', required=True, help='trained checkpoint')
+    parser.add_argument('--mode', default='dynamic', choices=['dynamic', 'static'])
+    parser.add_argument('--backend', default='x86', choices=['x86', 'fbgemm', 'qnnpack', 'onednn'],
+                        help='quantized kernels (qnnpack on ARM)')
+    parser.add_argument('--calib-list', default='train.list', help='dataset list used to calibrate --mode static')
+    parser.add_argument('--calib-batches', default=32, type=int)
+    parser.add_argument('--lists', default='test_seen.list,test_unseen.list',
+                        help='seen and unseen test lists for the accuracy report, empty to skip it')
+    parser.add_argument('--max-images', default=0, type=int, help='score at most this many images per list')
+    parser.add_argument('-b', '--batch-size', default=32, type=int)
+    parser.add_argument('-j', '--workers', default=4, type=int)
+    parser.add_argument('--threads', default=0, type=int, help='intra-op CPU threads (default: torch default)')
+    parser.add_argument('--repeats', default=10, type=int, help='timed forward passes per batch size')
+    args = parser.parse_args()
+
+    from infer import ImageList, collate
+    from inference import load_model
+    from utils import Uint8Normalize, preprocess_strategy
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    model, margs, store, _ = load_model(args.resume, device='cpu')
+    margs.uint8_transport = True
+    margs.flippingtest = False
+    _, _, val_transforms, val_transforms2 = preprocess_strategy(margs.data, margs)
+    to_float = Uint8Normalize()
+
+    def loader(list_name, limit=0, shuffle=False):
+        samples = store.samples(list_name)
+        dataset = ImageList(samples, val_transforms, val_transforms2)
+        if shuffle or limit:
+            # a fixed random subset, so that calibration covers all classes
+            order = np.random.RandomState(0).permutation(len(samples)) if shuffle else np.arange(len(samples))
+            dataset = data.Subset(dataset, order[:limit or len(samples)].tolist())
+            dataset.samples = samples
+        return data.DataLoader(dataset, batch_size=args.batch_size, num_workers=args.workers, collate_fn=collate)
+
+    start = time.time()
+    if args.mode == 'dynamic':
+        qmodel = quantize_dynamic(model)
+    else:
+        calib = (to_float(images) for images, _, _ in
+                 loader(args.calib_list, args.calib_batches * args.batch_size, shuffle=True) if images is not None)
+        qmodel = quantize_static(model, calib, args.backend)
+    print('=> quantized ({}) in {:.1f}s'.format(args.mode, time.time() - start))
+
+    print('{:>10} {:>10} {:>12} {:>14}'.format('model', 'size MB', 'ms (b=1)', 'ms (b={})'.format(args.batch_size)))
+    # input shape of the validation preprocessing
+    shape = val_transforms2(val_transforms(Image.new('RGB', (512, 512)))).shape
+    for name, m in (('float32', model), (args.mode, qmodel)):
+        print('{:>10} {:10.1f} {:12.1f} {:14.1f}'.format(
+            name, serialized_mb(m), latency_ms(m, torch.randn((1,) + shape), args.repeats),
+            latency_ms(m, torch.randn((args.batch_size,) + shape), max(1, args.repeats // 4))))
+
+    if args.lists:
+        loaders = [loader(name, args.max_images) for name in args.lists.split(',')]
+        (scores, odr, zsl), (qscores, qodr, qzsl) = [evaluate(m, loaders, to_float, store, margs.data)
+                                                     for m in (model, qmodel)]
+        print('=> top-1 agreement with float32: ODR {:.2%}, ZSR {:.2%}'.format(
+            np.mean(odr.argmax(1) == qodr.argmax(1)), np.mean(zsl.argmax(1) == qzsl.argmax(1))))
+        drop = dict((k, scores[k] - qscores[k]) for k in scores)
+        print('{:>10} {:>8} {:>8} {:>8} {:>8} {:>8} {:>8}'.format('model', 'H', 'S', 'U', 'H_opt', 'S_opt', 'U_opt'))
+        for name, s in (('float32', scores), (args.mode, qscores), ('drop', drop)):
+            print('{:>10} {H:8.4f} {ST:8.4f} {UT:8.4f} {H_opt:8.4f} {S_opt:8.4f} {U_opt:8.4f}'.format(name, **s))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""Recomputes the GZSL evaluation from logits stored by ``main.py --save-logits``.
+
+    python rescore.py /zero-shot/cub/.../logits_epoch*.npz
+    python rescore.py logits_epoch012.npz --bases 0.05:0.95:0.01 --stacking 0:1:0.05
+
+Prints SS/UU/ST/UT/H, CLS and the ``post_process`` sweep of every file exactly
+as ``validate`` computes them, with the model out of the loop. ``--bases``
+sweeps other ODR thresholds and ``--stacking`` adds calibrated stacking (seen-class
+ZSR probabilities lowered by gamma before the argmax over all classes).
+"""
+import argparse
+import json
+
+import numpy as np
+
+from logit_store import load_logits
+from utils import compute_class_accuracy_total, gzsl_scores, softmax
+
+
+def parse_grid(spec):
+    """``'0.1,0.2'`` or an inclusive range ``'start:stop:step'``."""
+    if ':' in spec:
+        start, stop, step = [float(v) for v in spec.split(':')]
+        return list(np.round(np.arange(start, stop + step / 2, step), 10))
+    return [float(v) for v in spec.split(',')]
+
+
+def calibrated_stacking(store, gammas):
+    """Best (gamma, S, U, H) of ZSR predictions over all classes with seen-class scores reduced by gamma."""
+    seen_c, unseen_c = store['seen_class'], store['unseen_class']
+    best = (0., 0., 0., 0.)
+    for gamma in gammas:
+        accs = []
+        for zsl, gt, classes in ((store['zsl_s'], store['gt_s'], seen_c), (store['zsl_t'], store['gt_t'], unseen_c)):
+            prob = zsl.copy() if store['probs'] else softmax(zsl)
+            prob[:, seen_c] -= gamma
+            accs.append(compute_class_accuracy_total(gt, np.argmax(prob, axis=1), classes))
+        S, U = accs
+        H = 2 * S * U / (S + U) if S + U > 0 else 0.
+        if H > best[3]:
+            best = (gamma, S, U, H)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='offline GZSL re-scoring of stored validation logits')
+    parser.add_argument('files', nargs='+', help='.npz files written by main.py --save-logits')
+    parser.add_argument('--bases', default=None, type=parse_grid,
+                        help='ODR thresholds for post_process, "0.1,0.5" or "start:stop:step" (default 0.1:0.9:0.1)')
+    parser.add_argument('--stacking', default=None, type=parse_grid,
+                        help='also sweep calibrated stacking over these gammas')
+    parser.add_argument('--json', default=None, help='append one JSON line of scores per file here')
+    args = parser.parse_args()
+
+    for filename in args.files:
+        store = load_logits(filename)
+        print('=> {} ({} seen / {} unseen test images{})'.format(filename, len(store['gt_s']), len(store['gt_t']),
+                                                               ', flipping test' if store['probs'] else ''))
+        scores = gzsl_scores(store['odr_s'], store['zsl_s'], store['gt_s'], store['odr_t'], store['zsl_t'],
+                             store['gt_t'], store['seen_class'], store['unseen_class'], store['meta'].get('data'),
+                             probs=store['probs'], bases=args.bases)
+        print('SS: {SS:.4f} UU: {UU:.4f} ST: {ST:.4f} UT: {UT:.4f} H: {H:.4f}'.format(**scores))
+        print('CLS {CLS:.4f} S_opt: {S_opt:.4f} U_opt {U_opt:.4f} H_opt {H_opt:.4f} Ds_opt {Ds_opt:.4f} '
+              'Du_opt {Du_opt:.4f} tau {tau:.4f} base {base:.4f}'.format(**scores))
+        if args.stacking is not None:
+            gamma, S, U, H = calibrated_stacking(store, args.stacking)
+            scores.update(cs_gamma=gamma, cs_S=S, cs_U=U, cs_H=H)
+            print('CS S: {:.4f} U: {:.4f} H: {:.4f} gamma {:.4f}'.format(S, U, H, gamma))
+        if args.json:
+            with open(args.json, 'a') as f:
+                f.write(json.dumps(dict(file=filename, **dict((k, float(v)) for k, v in scores.items()))) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+import json
+import os
+import warnings
+
+import numpy as np
+
+
+CACHE_VERSION = 1
+
+
+def _stamp(path):
+    st = os.stat(path)
+    return [st.st_mtime_ns, st.st_size]
+
+
+def _decode(value):
+    value = np.asarray(value).reshape(-1)[0] if not isinstance(value, bytes) else value
+    return value.decode('utf-8') if isinstance(value, bytes) else str(value)
+
+
+class SemanticStore(object):
+    """Class splits, attributes and sample lists of one dataset, read once and cached.
+
+    ``data_info.h5`` is parsed on first use and its arrays, together with derived
+    attribute matrices, are written as ``.npy`` files to ``cache_dir``. Later runs
+    memory-map them instead of opening the HDF5 file. The cache is rebuilt when the
+    mtime or size of ``data_info.h5`` changes; parsed sample lists are cached the
+    same way, keyed by their own list file.
+
+    Arrays:
+        all_att: class x attribute matrix as stored in ``data_info.h5``.
+        att_norm: ``all_att`` as float32 with unit L2 rows, ready for cosine scoring
+            against class prototypes.
+        seen_class, unseen_class, all_class: class indices of the splits.
+
+    Args:
+        data_dir (string): Directory with ``data_info.h5`` and the ``*.list`` files.
+        cache_dir (string, optional): Where the cache lives, ``<data_dir>/cache`` by
+            default. If it cannot be written the store works from memory.
+    """
+
+    def __init__(self, data_dir, cache_dir=None):
+        self.data_dir = data_dir
+        self.cache_dir = cache_dir or os.path.join(data_dir, 'cache')
+        self.source = os.path.join(data_dir, 'data_info.h5')
+        self._arrays = {}
+        self._meta = self._load_meta()
+        if self._meta is None or self._meta.get('source') != _stamp(self.source):
+            self._meta = self._build()
+
+    ''' cache files '''
+    def _file(self, name):
+        return os.path.join(self.cache_dir, name + '.npy')
+
+    def _load_meta(self):
+        try:
+            with open(os.path.join(self.cache_dir, 'meta.json'), 'r') as f:
+                meta = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        return meta if meta.get('version') == CACHE_VERSION else None
+
+    def _save_meta(self):
+        tmp = os.path.join(self.cache_dir, 'meta.json.{}.tmp'.format(os.getpid()))
+        with open(tmp, 'w') as f:
+            json.dump(self._meta, f, indent=2, sort_keys=True)
+        os.replace(tmp, os.path.join(self.cache_dir, 'meta.json'))
+
+    def _save_array(self, name, array):
+        self._arrays[name] = array
+        # concurrent ranks may rebuild at the same time, each writes its own file and renames it
+        tmp = os.path.join(self.cache_dir, '{}.{}.tmp.npy'.format(name, os.getpid()))
+        np.save(tmp, array)
+        os.replace(tmp, self._file(name))
+
+    def _writable(self):
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            return os.access(self.cache_dir, os.W_OK)
+        except OSError:
+            return False
+
+    def _build(self):
+        import h5py
+        with h5py.File(self.source, 'r') as data_info:
+            all_att = data_info['all_att'][...]
+            arrays = {'all_att': all_att,
+                      'seen_class': data_info['seen_class'][...],
+                      'unseen_class': data_info['unseen_class'][...],
+                      'all_class': np.arange(all_att.shape[0])}
+            img_path = _decode(data_info['img_path'][()])
+        att = all_att.astype(np.float32)
+        norm = np.linalg.norm(att, axis=1, keepdims=True)
+        arrays['att_norm'] = att / np.maximum(norm, 1e-12)
+
+        meta = {'version': CACHE_VERSION, 'source': _stamp(self.source), 'img_path': img_path,
+                'lists': {}}
+        if not self._writable():
+            warnings.warn('cannot write the semantic cache to {}, keeping it in memory'.format(self.cache_dir))
+            self._arrays = arrays
+            self.cache_dir = None
+            return meta
+        self._meta = meta
+        for name, array in arrays.items():
+            self._save_array(name, array)
+        self._save_meta()
+        return meta
+
+    def array(self, name):
+        """Returns a cached array, memory-mapped read-only."""
+        if name not in self._arrays:
+            self._arrays[name] = np.load(self._file(name), mmap_mode='r')
+        return self._arrays[name]
+
+    ''' dataset description '''
+    @property
+    def img_path(self):
+        return self._meta['img_path']
+
+    @property
+    def all_att(self):
+        return self.array('all_att')
+
+    @property
+    def att_norm(self):
+        return self.array('att_norm')
+
+    @property
+    def num_classes(self):
+        return self.all_att.shape[0]
+
+    @property
+    def sf_size(self):
+        return self.all_att.shape[1]
+
+    def semantic_data(self):
+        """The ``semantic_data`` dict used by training and evaluation."""
+        return {'seen_class': self.array('seen_class'),
+                'unseen_class': self.array('unseen_class'),
+                'all_class': self.array('all_class'),
+                'all_att': self.all_att}
+
+    def samples(self, list_name):
+        """Returns the ``dataset.folder.SampleIndex`` of ``<data_dir>/<list_name>`` rooted at ``img_path``."""
+        from dataset.folder import SampleIndex
+        data_list = os.path.join(self.data_dir, list_name)
+        key = os.path.splitext(list_name)[0]
+        names = ['{}.{}'.format(key, part) for part in ('paths', 'offsets', 'labels')]
+        if self.cache_dir is not None and self._meta['lists'].get(key) == _stamp(data_list):
+            return SampleIndex(self.img_path, *[self.array(n) for n in names])
+        index = SampleIndex.from_list(self.img_path, data_list)
+        if self.cache_dir is not None:
+            for name, array in zip(names, (index.paths, index.offsets, index.labels)):
+                self._save_array(name, array)
+            self._meta['lists'][key] = _stamp(data_list)
+            self._save_meta()
+        return index
@@ -0,0 +1,294 @@
+"""Local HTTP inference server with dynamic micro-batching.
+
+    python server.py --resume cub.model --port 8080 --max-batch 32 --max-wait-ms 10
+
+``POST /predict`` with the encoded image as request body returns the GZSL
+prediction as JSON. ``GET /stats`` reports request, batch and cache counters,
+``POST /config`` with ``{"max_wait_ms": 5}`` changes the batching deadline and
+``POST /reload`` with ``{"resume": "new.model"}`` swaps in another checkpoint.
+
+The logits of every image are cached under a hash of its bytes (see
+``prediction_cache.py``), so repeated images skip decoding and the model.
+"""
+import argparse
+import asyncio
+import collections
+import copy
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+from inference import Predictor
+from prediction_cache import PredictionCache, content_key
+
+
+class MicroBatcher(object):
+    """Collects concurrent requests into batches for ``run_batch``.
+
+    A batch is started as soon as ``max_batch`` items are waiting or ``max_wait_ms``
+    after its first item arrived, whichever comes first. Batches run one at a
+    time on a worker thread, so the event loop keeps accepting requests; items
+    that arrive meanwhile form the next batch.
+    """
+
+    def __init__(self, run_batch, max_batch=32, max_wait_ms=10.):
+        self.run_batch = run_batch
+        self.max_batch = max_batch
+        self.max_wait_ms = max_wait_ms
+        self.queue = asyncio.Queue()
+        self.executor = ThreadPoolExecutor(1)
+        self.requests = 0
+        self.batches = 0
+        self.busy = 0.
+
+    async def submit(self, item):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((item, future))
+        return await future
+
+    async def _collect(self):
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.max_wait_ms / 1000.
+        while len(batch) < self.max_batch:
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            start = time.time()
+            try:
+                results = await loop.run_in_executor(self.executor, self.run_batch, [item for item, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            else:
+                for (_, future), result in zip(batch, results):
+                    if not future.done():
+                        future.set_result(result)
+            self.busy += time.time() - start
+            self.requests += len(batch)
+            self.batches += 1
+
+    def stats(self):
+        return {'requests': self.requests, 'batches': self.batches,
+                'mean_batch': self.requests / max(1, self.batches), 'busy_s': self.busy,
+                'max_batch': self.max_batch, 'max_wait_ms': self.max_wait_ms}
+
+
+class Server(object):
+    """Minimal HTTP/1.1 front end (keep-alive, Content-Length bodies) for a Predictor.
+
+    Args:
+        cache (PredictionCache, optional): Logits of already seen images.
+    """
+
+    def __init__(self, predictor, max_batch, max_wait_ms, decode_threads, cache=None):
+        self.predictor = predictor
+        self.max_batch = max_batch
+        self.max_wait_ms = max_wait_ms
+        self.cache = cache
+        # requests for an image that is already being computed wait for that result
+        self.pending = {}
+        # image decoding and resizing release the GIL and run next to the model
+        self.decoder = ThreadPoolExecutor(decode_threads)
+
+    def _logits(self, batch):
+        # requests admitted before a reload still run on the model they were admitted with
+        groups = collections.OrderedDict()
+        for i, (predictor, image) in enumerate(batch):
+            groups.setdefault(id(predictor), (predictor, []))[1].append(i)
+        results = [None] * len(batch)
+        for predictor, indices in groups.values():
+            odr, zsl = predictor.logits([batch[i][1] for i in indices])
+            for i, logits in zip(indices, zip(odr, zsl)):
+                results[i] = logits
+        return results
+
+    async def _compute(self, predictor, body):
+        loop = asyncio.get_running_loop()
+        try:
+            image = await loop.run_in_executor(self.decoder, predictor.preprocess, body)
+        except Exception as e:
+            raise ValueError('cannot decode image: {}'.format(e))
+        return await self.batcher.submit((predictor, image))
+
+    async def predict(self, body):
+        # one model, threshold and set of seen classes for the whole request
+        predictor = self.predictor
+        try:
+            if self.cache is None or predictor.fingerprint != self.cache.fingerprint:
+                logits = await self._compute(predictor, body)
+            else:
+                logits = await self._cached(predictor, body)
+        except ValueError as e:
+            return 400, {'error': str(e)}
+        odr, zsl = logits
+        return 200, predictor.decide(odr[None], zsl[None])[0]
+
+    async def _cached(self, predictor, body):
+        fingerprint, key = predictor.fingerprint, content_key(body)
+        logits = self.cache.get(key)
+        if logits is not None:
+            return logits
+        if (fingerprint, key) in self.pending:
+            return await asyncio.shield(self.pending[fingerprint, key])
+        future = asyncio.get_running_loop().create_future()
+        self.pending[fingerprint, key] = future
+        try:
+            logits = await self._compute(predictor, body)
+        except Exception as e:
+            future.set_exception(e)
+            # retrieved here so that a future nobody else waits for does not warn
+            future.exception()
+            raise
+        finally:
+            del self.pending[fingerprint, key]
+        # a reload while the image was in flight makes its logits stale
+        if fingerprint == self.cache.fingerprint:
+            self.cache.put(key, logits)
+        future.set_result(logits)
+        return logits
+
+    async def reload(self, resume):
+        """Loads another checkpoint while the current one keeps serving, then swaps it in."""
+        loop = asyncio.get_running_loop()
+        predictor = copy.copy(self.predictor)
+        await loop.run_in_executor(None, predictor.load, resume)
+        self.predictor = predictor
+        if self.cache is not None:
+            self.cache.invalidate(predictor.fingerprint)
+            # deleting a large namespace would stall every request on the event loop
+            await loop.run_in_executor(None, self.cache.remove_stale)
+
+    def stats(self):
+        stats = self.batcher.stats()
+        stats['fingerprint'] = self.predictor.fingerprint
+        if self.cache is not None:
+            stats['cache'] = self.cache.stats()
+        return stats
+
+    async def route(self, method, path, body):
+        if method == 'POST' and path == '/predict':
+            return await self.predict(body)
+        if method == 'GET' and path == '/stats':
+            return 200, self.stats()
+        if method == 'GET' and path == '/health':
+            return 200, {'status': 'ok'}
+        if method == 'POST' and path == '/config':
+            try:
+                config = json.loads(body.decode('utf-8') or '{}')
+            except ValueError as e:
+                return 400, {'error': 'invalid JSON: {}'.format(e)}
+            if 'max_wait_ms' in config:
+                self.batcher.max_wait_ms = float(config['max_wait_ms'])
+            if 'max_batch' in config:
+                self.batcher.max_batch = int(config['max_batch'])
+            return 200, self.stats()
+        if method == 'POST' and path == '/reload':
+            try:
+                config = json.loads(body.decode('utf-8') or '{}')
+            except ValueError as e:
+                return 400, {'error': 'invalid JSON: {}'.format(e)}
+            try:
+                await self.reload(config['resume'])
+            except Exception as e:
+                return 400, {'error': 'cannot load {}: {}'.format(config.get('resume'), e)}
+            return 200, self.stats()
+        return 404, {'error': 'not found'}
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path = request_line.decode('latin-1').split()[:2]
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                try:
+                    status, payload = await self.route(method, path.split('?')[0], body)
+                except Exception as e:
+                    # e.g. a failing forward pass; answer instead of dropping the connection
+                    status, payload = 500, {'error': '{}: {}'.format(type(e).__name__, e)}
+                data = json.dumps(payload).encode('utf-8')
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                writer.write('HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n'
+                             'Connection: {}\r\n\r\n'.format(status, 'OK' if status == 200 else 'Error', len(data),
+                                                             'keep-alive' if keep_alive else 'close')
+                             .encode('latin-1') + data)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host, port):
+        self.batcher = MicroBatcher(self._logits, self.max_batch, self.max_wait_ms)
+        batcher = asyncio.ensure_future(self.batcher.run())
+        server = await asyncio.start_server(self.handle, host, port)
+        print('serving on http://{}:{} (max batch {}, max wait {}ms)'.format(host, port, self.max_batch,
+                                                                           self.max_wait_ms))
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='fpa inference server')
+    parser.add_argument('--resume', required=True, help='trained checkpoint')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', default=8080, type=int)
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--max-batch', default=32, type=int, help='largest micro-batch')
+    parser.add_argument('--max-wait-ms', default=10., type=float,
+                        help='how long the first request of a batch waits for others')
+    parser.add_argument('--decode-threads', default=4, type=int, help='threads decoding and resizing images')
+    parser.add_argument('--threshold', default=None, type=float,
+                        help='ODR confidence threshold (default: calibrated value in the checkpoint)')
+    parser.add_argument('--topk', default=5, type=int)
+    parser.add_argument('--quantize', default=None, choices=['dynamic'],
+                        help='int8 Linear layers for CPU inference (see quantize.py)')
+    parser.add_argument('--cache-size', default=10000, type=int,
+                        help='images whose logits are kept in memory (0 disables the cache)')
+    parser.add_argument('--cache-dir', default=None,
+                        help='also keep cached logits on disk, across restarts (in its prediction_cache subdirectory)')
+    args = parser.parse_args()
+
+    predictor = Predictor(args.resume, args.device, args.threshold, args.topk, quantize=args.quantize)
+    cache = None
+    if args.cache_size > 0:
+        cache = PredictionCache(predictor.fingerprint, args.cache_size, args.cache_dir)
+    server = Server(predictor, args.max_batch, args.max_wait_ms, args.decode_threads, cache)
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
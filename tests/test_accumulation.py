@@ -0,0 +1,75 @@
+import torch
+import torch.distributed as dist
+import torch.nn as nn
+import torch.nn.functional as F
+
+from utils import accumulate_gradients, freeze_bn
+
+
+class TinyModel(nn.Module):
+
+    def __init__(self):
+        super(TinyModel, self).__init__()
+        self.conv = nn.Conv2d(3, 8, 3)
+        self.bn = nn.BatchNorm2d(8)
+        self.fc = nn.Linear(8, 5)
+        self.att = nn.Linear(8, 4)
+
+    def forward(self, x):
+        x = F.relu(self.bn(self.conv(x))).mean((2, 3))
+        return (self.fc(x), self.att(x)), x
+
+
+def criterion(target, logits, att):
+    L_odr = F.cross_entropy(logits[0], target)
+    L_zsr = F.mse_loss(logits[1], att)
+    L_aux = logits[0].pow(2).mean()
+    L_fft = logits[1].abs().mean()
+    return L_odr + L_zsr + L_aux + L_fft, L_odr, L_zsr, L_aux, L_fft
+
+
+def batch(n=6):
+    torch.manual_seed(1)
+    return torch.randn(n, 3, 8, 8), torch.randint(0, 5, (n,)), torch.randn(n, 4)
+
+
+def grads(model, steps):
+    model.zero_grad()
+    model.train()
+    freeze_bn(model)
+    losses = accumulate_gradients(model, criterion, *batch(), steps=steps)
+    return losses, [p.grad.clone() for p in model.parameters()]
+
+
+def test_micro_batches_match_full_batch():
+    torch.manual_seed(0)
+    model = TinyModel()
+    losses, full = grads(model, 1)
+    for steps in (2, 3, 4):
+        accum_losses, accum = grads(model, steps)
+        assert torch.allclose(losses, accum_losses, atol=1e-6)
+        for g, a in zip(full, accum):
+            assert torch.allclose(g, a, atol=1e-6)
+
+
+def test_ddp_reduces_once_per_batch(tmp_path):
+    dist.init_process_group('gloo', init_method='file://' + str(tmp_path / 'store'), rank=0, world_size=1)
+    try:
+        torch.manual_seed(0)
+        model = nn.parallel.DistributedDataParallel(TinyModel())
+        calls = []
+
+        def hook(state, bucket):
+            calls.append(bucket.index())
+            fut = torch.futures.Future()
+            fut.set_result(bucket.buffer())
+            return fut
+
+        model.register_comm_hook(None, hook)
+        _, full = grads(model.module, 1)
+        _, accum = grads(model, 3)
+        assert calls and len(calls) == len(set(calls))
+        for g, a in zip(full, accum):
+            assert torch.allclose(g, a, atol=1e-6)
+    finally:
+        dist.destroy_process_group()
@@ -0,0 +1,51 @@
+import argparse
+
+import numpy as np
+import torch
+import torch.nn as nn
+from PIL import Image
+
+from attribute_index import AttributeIndex, extract_attributes, image_loader
+from dataset.folder import SampleIndex
+from utils import Uint8Normalize
+
+
+class AttributeModel(nn.Module):
+    """Stands in for fpa.Model: ``logits[3]`` is a deterministic function of the image."""
+
+    def __init__(self):
+        super(AttributeModel, self).__init__()
+        self.pool = nn.AdaptiveAvgPool2d(4)
+        self.fc = nn.Linear(48, 8)
+
+    def forward(self, x):
+        att = self.fc(self.pool(x).flatten(1)).relu()
+        return (None, None, None, att), None
+
+
+def build(samples, model):
+    loader = image_loader(samples, argparse.Namespace(data='cub', aug='v7'), batch_size=2, workers=0)
+    att, ids = [torch.cat(t) for t in zip(*extract_attributes(model, loader, 'cpu', Uint8Normalize()))]
+    index = AttributeIndex(att.size(1), nlist=2, nprobe=2).train(att)
+    index.add(att, ids)
+    return att, ids, index
+
+
+def test_build_is_deterministic(tmp_path):
+    rng = np.random.RandomState(0)
+    names = []
+    for i in range(5):
+        Image.fromarray(rng.randint(0, 256, (60, 80, 3), dtype=np.uint8)).save(str(tmp_path / '{}.jpg'.format(i)))
+        names.append('{}.jpg'.format(i).encode())
+    (tmp_path / 'broken.jpg').write_bytes(b'not an image')
+    names.insert(2, b'broken.jpg')
+    samples = SampleIndex.from_paths(str(tmp_path), names)
+    torch.manual_seed(0)
+    model = AttributeModel()
+
+    att, ids, index = build(samples, model)
+    att2, ids2, index2 = build(samples, model)
+    assert torch.equal(att, att2)
+    # ids are the positions in the list, the undecodable image is skipped
+    assert ids.tolist() == ids2.tolist() == [0, 1, 3, 4, 5]
+    assert torch.equal(index.search(att, 3)[1], index2.search(att, 3)[1])
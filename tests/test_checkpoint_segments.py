@@ -0,0 +1,47 @@
+import argparse
+import copy
+import random
+
+import numpy as np
+import torch
+
+from models import fpa
+
+
+def make_args():
+    rng = np.random.RandomState(0)
+    return argparse.Namespace(num_classes=6, sf_size=8, sf=rng.rand(6, 8).astype(np.float32), batch_size=2,
+                              phasew=0.0, att=8, sigma=0.5, lossw=1, odr=0, backbone='resnet101', adj=None,
+                              is_fix=False)
+
+
+def step(model, criterion, x, y, att):
+    random.seed(0)
+    torch.manual_seed(0)
+    model.zero_grad()
+    logits, _ = model(x)
+    criterion(y, logits, att)[0].backward()
+    return dict((name, p.grad.clone()) for name, p in model.named_parameters() if p.grad is not None)
+
+
+def test_checkpointed_gradients_match():
+    torch.manual_seed(0)
+    args = make_args()
+    model, criterion = fpa.fpa(args=args)
+    checkpointed = copy.deepcopy(model)
+    checkpointed.checkpoint_segments = fpa.parse_checkpoint_segments('layer1,layer2:2,layer3:6,layer4,odr,fft')
+    model.train()
+    checkpointed.train()
+
+    x = torch.randn(2, 3, 32, 32)
+    y = torch.tensor([1, 4])
+    att = model.sf[y]
+    grads = step(model, criterion, x, y, att)
+    checkpointed_grads = step(checkpointed, criterion, x, y, att)
+
+    assert grads and sorted(grads) == sorted(checkpointed_grads)
+    for name, g in grads.items():
+        assert torch.allclose(g, checkpointed_grads[name], rtol=1e-4, atol=1e-6), name
+    # the recomputation in backward must not update the BN statistics a second time
+    for (name, b), c in zip(model.named_buffers(), checkpointed.buffers()):
+        assert torch.equal(b, c), name
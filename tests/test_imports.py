@@ -0,0 +1,25 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY = ['skimage', 'scipy', 'cv2', 'h5py', 'torchvision']
+
+
+def imported_by(module):
+    """Top-level packages loaded by ``import module`` in a fresh interpreter."""
+    code = 'import json, sys; import {}; print(json.dumps(sorted(sys.modules)))'.format(module)
+    out = subprocess.check_output([sys.executable, '-c', code], cwd=ROOT, universal_newlines=True)
+    return set(name.partition('.')[0] for name in json.loads(out.splitlines()[-1]))
+
+
+@pytest.mark.parametrize('module', ['models', 'dataset.folder', 'utils', 'semantic', 'checkpointing'])
+def test_no_heavy_imports(module):
+    assert imported_by(module).isdisjoint(HEAVY)
+
+
+def test_model_registry_does_not_import_torch():
+    assert 'torch' not in imported_by('models')
@@ -0,0 +1,26 @@
+import torch
+import torch.nn as nn
+
+from checkpointing import materialize
+from models.fpa import init_module
+
+
+def build():
+    with torch.device('meta'):
+        return nn.Sequential(nn.Conv2d(3, 4, 3, bias=False), nn.BatchNorm2d(4), nn.Linear(4, 2))
+
+
+def test_legacy_bn_statistics_survive():
+    torch.manual_seed(0)
+    # a pre-0.4.1 style state dict: BN layers without num_batches_tracked, no Linear
+    legacy = {'0.weight': torch.randn(4, 3, 3, 3), '1.weight': torch.rand(4) + 0.5, '1.bias': torch.randn(4),
+              '1.running_mean': torch.randn(4), '1.running_var': torch.rand(4) + 0.5}
+    model = build()
+    missing, unexpected = materialize(model, 'cpu', legacy, init_module)
+
+    state = model.state_dict()
+    for k, v in legacy.items():
+        assert torch.equal(state[k], v), k
+    assert state['1.num_batches_tracked'].item() == 0
+    assert missing == ['2.weight', '2.bias'] and unexpected == []
+    assert torch.isfinite(state['2.weight']).all() and torch.isfinite(state['2.bias']).all()
@@ -0,0 +1,27 @@
+import pickle
+import sys
+import threading
+
+from utils import PipelineStats
+
+
+def test_concurrent_records_are_not_lost():
+    # as in a loader worker: unpickled, then fed by the decode threads
+    stats = pickle.loads(pickle.dumps(PipelineStats(1)))
+
+    def fetch():
+        for _ in range(20000):
+            stats.record('decode', 1e-3)
+
+    threads = [threading.Thread(target=fetch) for _ in range(8)]
+    # switch threads as often as possible to provoke interleaved updates
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    finally:
+        sys.setswitchinterval(interval)
+    assert stats.summary()['decode']['count'] == 8 * 20000
@@ -0,0 +1,22 @@
+import contextlib
+import io
+
+import numpy as np
+
+from utils import post_process
+
+
+def test_bases_order_does_not_matter():
+    rng = np.random.RandomState(0)
+    seen_c, unseen_c = np.arange(5), np.arange(5, 10)
+    gt = np.concatenate([rng.choice(seen_c, 40), rng.choice(unseen_c, 40)])
+    v_prob = rng.dirichlet(np.ones(10) * 0.3, 80)
+    a_prob = rng.dirichlet(np.ones(10) * 0.3, 80)
+
+    def scores(bases):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return post_process(v_prob, a_prob, gt, 40, seen_c, unseen_c, 'cub', bases=bases)
+
+    best = scores([0.2, 0.5, 0.8])
+    assert scores([0.8, 0.5, 0.2]) == best
+    assert best == max((scores([b]) for b in [0.2, 0.5, 0.8]), key=lambda s: s[0])
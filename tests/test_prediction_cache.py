@@ -0,0 +1,19 @@
+import os
+
+import numpy as np
+
+from prediction_cache import NAMESPACE_DIR, PredictionCache
+
+
+def test_invalidate_leaves_deletion_to_remove_stale(tmp_path):
+    cache = PredictionCache('old', disk_dir=str(tmp_path))
+    cache.put('ab' * 16, (np.zeros(3), np.ones(3)))
+    root = tmp_path / NAMESPACE_DIR
+
+    cache.invalidate('new')
+    assert len(cache) == 0
+    assert cache.get('ab' * 16) is None
+    assert sorted(os.listdir(str(root))) == ['new', 'old']
+
+    cache.remove_stale()
+    assert os.listdir(str(root)) == ['new']
@@ -0,0 +1,44 @@
+import argparse
+
+import numpy as np
+import torch
+
+from models import fpa
+
+
+def make_args():
+    rng = np.random.RandomState(0)
+    return argparse.Namespace(num_classes=6, sf_size=8, sf=rng.rand(6, 8).astype(np.float32), batch_size=2,
+                              phasew=0.0, att=8, sigma=0.5, lossw=2, odr=0, backbone='resnet101', adj=None,
+                              is_fix=False)
+
+
+def test_single_backward_matches_two_passes():
+    torch.manual_seed(0)
+    args = make_args()
+    model, criterion = fpa.fpa(args=args)
+    model.train()
+    # the parameter groups of odr_optimizer and zsr_optimizer in main.py
+    groups = [[(k, v) for k, v in model.named_parameters() if 'odr_' in k],
+              [(k, v) for k, v in model.named_parameters() if 'zsr_' in k]]
+    assert all(groups) and not set(k for k, _ in groups[0]) & set(k for k, _ in groups[1])
+
+    x = torch.randn(2, 3, 32, 32)
+    y = torch.tensor([1, 4])
+    logits, _ = model(x)
+    total_loss, L_odr, L_zsr, L_aux, L_fft = criterion(y, logits, model.sf[y])
+
+    # the former scheme: L_odr first, then the ZSR terms
+    L_odr.backward(retain_graph=True)
+    (L_zsr + L_aux + L_fft * args.lossw).backward(retain_graph=True)
+    two_pass = [dict((k, v.grad.clone()) for k, v in group if v.grad is not None) for group in groups]
+    model.zero_grad()
+
+    total_loss.backward()
+    for grads, group in zip(two_pass, groups):
+        assert grads
+        for k, v in group:
+            if k in grads:
+                assert torch.allclose(v.grad, grads[k], rtol=1e-5, atol=1e-7), k
+            else:
+                assert v.grad is None, k
@@ -0,0 +1,16 @@
+import os
+
+import pytest
+
+from dataset.folder import SampleIndex
+
+
+def test_from_list_unlabeled_lines(tmp_path):
+    data_list = tmp_path / 'images.list'
+    data_list.write_bytes(b'a/1.jpg 3 0.5 extra\n\nb/2.jpg\nc/3.jpg 7\n')
+
+    samples = SampleIndex.from_list('root', str(data_list), labeled=False)
+    assert list(samples) == [(os.path.join('root', 'a/1.jpg'), 3), (os.path.join('root', 'b/2.jpg'), -1),
+                             (os.path.join('root', 'c/3.jpg'), 7)]
+    with pytest.raises(RuntimeError):
+        SampleIndex.from_list('root', str(data_list))
@@ -0,0 +1,74 @@
+"""Reports where the start-up time of an entry point goes.
+
+Runs ``python -X importtime -c 'import <module>'`` in a fresh interpreter, lists the
+slowest direct imports, and times ``python main.py --help`` (time to argparse).
+
+    python tools/import_report.py --module main --top 15 --budget 2.0
+
+Exits with status 1 when the import takes longer than ``--budget`` seconds, so it
+can run as a start-up regression check.
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_times(module):
+    """Returns ``[(name, self_us, cumulative_us, depth)]`` for every import of ``module``."""
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+                          cwd=ROOT, stderr=subprocess.PIPE, universal_newlines=True)
+    rows = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip(' '))) // 2
+        rows.append((name.strip(), int(self_us), int(cumulative_us), depth))
+    if proc.returncode != 0:
+        print(proc.stderr.strip().splitlines()[-1], file=sys.stderr)
+    return rows, proc.returncode
+
+
+def time_to_argparse(script, repeats=3):
+    """Best wall time of ``python <script> --help`` over ``repeats`` runs."""
+    best = None
+    for _ in range(repeats):
+        start = time.time()
+        subprocess.run([sys.executable, script, '--help'], cwd=ROOT,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='import-time report')
+    parser.add_argument('--module', default='main', help='module to import')
+    parser.add_argument('--top', default=15, type=int, help='number of imports to list')
+    parser.add_argument('--budget', default=None, type=float, help='fail above this many seconds')
+    args = parser.parse_args()
+
+    rows, returncode = import_times(args.module)
+    total = sum(r[2] for r in rows if r[3] == 0) / 1e6
+    # depth 1: the modules imported directly by args.module (and by site)
+    direct = [r for r in rows if r[3] == 1]
+    print('{:>10} {:>10}  {}'.format('self [s]', 'cum [s]', 'imports of ' + args.module))
+    for name, self_us, cumulative_us, _ in sorted(direct, key=lambda r: -r[2])[:args.top]:
+        print('{:10.3f} {:10.3f}  {}'.format(self_us / 1e6, cumulative_us / 1e6, name))
+    print('total import time of {}: {:.3f}s'.format(args.module, total))
+    script = os.path.join(ROOT, args.module + '.py')
+    if os.path.isfile(script):
+        print('time to argparse ({} --help): {:.3f}s'.format(os.path.basename(script), time_to_argparse(script)))
+    if returncode != 0:
+        sys.exit(returncode)
+    if args.budget is not None and total > args.budget:
+        print('import time {:.3f}s exceeds the budget of {:.3f}s'.format(total, args.budget))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+"""Load generator for server.py.
+
+Keeps ``--concurrency`` keep-alive connections busy posting an image and reports
+throughput and p50/p99 latency for every batching deadline in ``--deadlines``
+(set on the running server through ``POST /config``). Every request appends 16
+random bytes to the image, which decoders ignore, so that each one misses the
+server's prediction cache and the model is measured; ``--repeat`` posts the
+identical image to measure cache hits instead.
+
+    python tools/loadgen.py --image bird.jpg --concurrency 32 --duration 10 --deadlines 0,2,5,10,20
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+
+import numpy as np
+
+
+async def request(reader, writer, host, method, path, body=b''):
+    writer.write('{} {} HTTP/1.1\r\nHost: {}\r\nContent-Length: {}\r\n\r\n'.format(method, path, host, len(body))
+                 .encode('latin-1') + body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        if name.strip().lower() == 'content-length':
+            length = int(value)
+    return status, await reader.readexactly(length)
+
+
+async def call(host, port, method, path, body=b''):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        status, data = await request(reader, writer, host, method, path, body)
+    finally:
+        writer.close()
+    return status, json.loads(data.decode('utf-8'))
+
+
+async def client(host, port, image, stop, latencies, errors, repeat=False):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        while time.time() < stop:
+            body = image if repeat else image + os.urandom(16)
+            start = time.time()
+            status, _ = await request(reader, writer, host, 'POST', '/predict', body)
+            if status == 200:
+                latencies.append(time.time() - start)
+            else:
+                errors.append(status)
+    finally:
+        writer.close()
+
+
+async def run(args):
+    with open(args.image, 'rb') as f:
+        image = f.read()
+    print('{:>9} {:>9} {:>9} {:>9} {:>10} {:>7}'.format('wait ms', 'req/s', 'p50 ms', 'p99 ms', 'mean batch',
+                                                         'errors'))
+    for deadline in [float(d) for d in args.deadlines.split(',')]:
+        await call(args.host, args.port, 'POST', '/config', json.dumps({'max_wait_ms': deadline}).encode())
+        # warm up, then measure
+        await asyncio.gather(*[client(args.host, args.port, image, time.time() + args.warmup, [], [], args.repeat)
+                               for _ in range(args.concurrency)])
+        _, before = await call(args.host, args.port, 'GET', '/stats')
+        latencies, errors = [], []
+        start = time.time()
+        await asyncio.gather(*[client(args.host, args.port, image, start + args.duration, latencies, errors,
+                                      args.repeat) for _ in range(args.concurrency)])
+        elapsed = time.time() - start
+        _, after = await call(args.host, args.port, 'GET', '/stats')
+        batches = max(1, after['batches'] - before['batches'])
+        ms = np.asarray(latencies) * 1e3
+        print('{:9.1f} {:9.1f} {:9.1f} {:9.1f} {:10.2f} {:7d}'.format(
+            deadline, len(latencies) / elapsed, np.percentile(ms, 50) if len(ms) else float('nan'),
+            np.percentile(ms, 99) if len(ms) else float('nan'), (after['requests'] - before['requests']) / batches,
+            len(errors)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='load generator for server.py')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', default=8080, type=int)
+    parser.add_argument('--image', required=True, help='image posted by every request')
+    parser.add_argument('--concurrency', default=32, type=int, help='concurrent connections')
+    parser.add_argument('--duration', default=10., type=float, help='seconds measured per deadline')
+    parser.add_argument('--warmup', default=2., type=float, help='seconds of warm-up per deadline')
+    parser.add_argument('--deadlines', default='0,2,5,10,20', help='comma-separated max-wait values in ms')
+    parser.add_argument('--repeat', action='store_true',
+                        help='post the identical image every time, so that requests hit the prediction cache')
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
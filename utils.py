@@ -1,17 +1,232 @@
 import numpy as np
 import torch.nn as nn
-import scipy.sparse as sp
 from PIL import Image
 from PIL import ImageFilter
 import random
-import torchvision.transforms as transforms
+import bisect
+import collections
+import contextlib
+import json
+import queue
+import threading
 import torch
-
-normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406],
-                                 std=[0.229, 0.224, 0.225])
+import torch.distributed as dist
+
+IMAGENET_MEAN = [0.485, 0.456, 0.406]
+IMAGENET_STD = [0.229, 0.224, 0.225]
+
+
+class Uint8Normalize(object):
+    """Converts a uint8 CHW batch to normalized float in one fused op.
+
+    Used with ``--uint8-transport`` so that workers ship uint8 tensors and the
+    float conversion happens on the device that consumes the batch. Float
+    inputs are returned unchanged.
+    """
+
+    def __init__(self, mean=IMAGENET_MEAN, std=IMAGENET_STD):
+        self.mean = mean
+        self.std = std
+        self._cache = {}
+
+    def __call__(self, x, dtype=torch.float32):
+        if x.dtype != torch.uint8:
+            return x
+        key = (x.device, dtype)
+        if key not in self._cache:
+            mean = torch.tensor(self.mean, dtype=dtype, device=x.device).view(-1, 1, 1)
+            std = torch.tensor(self.std, dtype=dtype, device=x.device).view(-1, 1, 1)
+            self._cache[key] = (1. / (255. * std), -mean / std)
+        scale, shift = self._cache[key]
+        return torch.addcmul(shift, x.to(dtype), scale)
+
+
+class BatchPrefetcher(object):
+    """Stages batch i+1 on the training device while batch i is computed.
+
+    Every batch is transferred, converted with ``to_float`` (see Uint8Normalize)
+    and its per-sample attributes are gathered from ``att_table``, a class x
+    attribute tensor kept on the device. Repeated-augmentation views are folded
+    into the batch. On CUDA the staging runs on a side stream, on CPU on a
+    background thread.
+
+    Yields:
+        tuple: (input, target, att) on ``device``.
+    """
+
+    def __init__(self, loader, device, att_table, to_float, depth=2):
+        self.loader = loader
+        self.device = device
+        self.att_table = att_table
+        self.to_float = to_float
+        self.depth = depth
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _prepare(self, input, target):
+        if input.dim() == 5:
+            # repeated augmentation: fold the views into the batch
+            input = input.view(-1, *input.shape[2:])
+            target = target.view(-1)
+        input = self.to_float(input.to(self.device, non_blocking=True))
+        target = target.to(self.device, non_blocking=True)
+        return input, target, self.att_table[target]
+
+    def __iter__(self):
+        if self.device.type == 'cuda':
+            return self._iter_stream()
+        return self._iter_thread()
+
+    def _iter_stream(self):
+        stream = torch.cuda.Stream(device=self.device)
+        current = torch.cuda.current_stream(self.device)
+        batch = None
+        for input, target in self.loader:
+            with torch.cuda.stream(stream):
+                next_batch = self._prepare(input, target)
+            if batch is not None:
+                yield batch
+            current.wait_stream(stream)
+            for t in next_batch:
+                t.record_stream(current)
+            batch = next_batch
+        if batch is not None:
+            yield batch
+
+    def _iter_thread(self):
+        batches = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        done = object()
+
+        def offer(item):
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def produce():
+            try:
+                for input, target in self.loader:
+                    if not offer(self._prepare(input, target)):
+                        return
+            except Exception as e:
+                offer(e)
+                return
+            offer(done)
+
+        thread = threading.Thread(target=produce, daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = batches.get()
+                if item is done:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            thread.join()
+
+
+class PipelineStats(object):
+    """Opt-in latency histograms for the stages of the input pipeline.
+
+    Loader workers record ``read``/``decode``/``transform``/``lowfft``/``transform2``/
+    ``collate`` times and the training loop records ``wait`` (time blocked on the
+    loader) and ``step`` (compute). Counts live in a shared-memory tensor with one
+    row per worker (row 0 is the main process), so worker timings are visible to
+    the main process without any extra IPC.
+
+    Args:
+        num_workers (int): Number of DataLoader workers that will record.
+    """
+    STAGES = ['read', 'decode', 'load', 'transform', 'lowfft', 'transform2', 'collate', 'wait', 'step']
+    # 8 log-spaced bins per decade from 10us to 100s
+    EDGES = np.logspace(-5, 2, 57).tolist()
+
+    def __init__(self, num_workers):
+        rows = num_workers + 1
+        self.counts = torch.zeros(rows, len(self.STAGES), len(self.EDGES) + 1, dtype=torch.int64).share_memory_()
+        self.totals = torch.zeros(rows, len(self.STAGES), dtype=torch.float64).share_memory_()
+        self._index = {stage: i for i, stage in enumerate(self.STAGES)}
+        self._views = None
+        # the decode threads of a process (--fetch-threads) share its row
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_views'] = None
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def record(self, stage, seconds):
+        info = torch.utils.data.get_worker_info()
+        row = 0 if info is None else info.id + 1
+        s = self._index[stage]
+        b = bisect.bisect_right(self.EDGES, seconds)
+        with self._lock:
+            if self._views is None:
+                # numpy views on the shared storage make the update ~100ns
+                self._views = (self.counts.numpy(), self.totals.numpy())
+            counts, totals = self._views
+            counts[row, s, b] += 1
+            totals[row, s] += seconds
+
+    def reset(self):
+        self.counts.zero_()
+        self.totals.zero_()
+
+    def _percentile(self, hist, q):
+        cum = np.cumsum(hist)
+        b = int(np.searchsorted(cum, q * cum[-1]))
+        return self.EDGES[min(b, len(self.EDGES) - 1)]
+
+    def summary(self):
+        """Aggregates all workers into ``{stage: {count, total, mean, p50, p99}}``."""
+        counts = self.counts.sum(0).numpy()
+        totals = self.totals.sum(0).numpy()
+        summary = {}
+        for stage, s in self._index.items():
+            n = int(counts[s].sum())
+            if n == 0:
+                continue
+            summary[stage] = {'count': n, 'total': float(totals[s]), 'mean': float(totals[s]) / n,
+                              'p50': self._percentile(counts[s], 0.5), 'p99': self._percentile(counts[s], 0.99)}
+        return summary
+
+    def bottleneck(self, summary):
+        """Classifies a run as compute-, I/O- or decode-bound from a summary."""
+        total = lambda k: summary[k]['total'] if k in summary else 0.
+        if total('wait') <= 0.1 * (total('wait') + total('step')):
+            return 'compute-bound'
+        io = total('read')
+        cpu = sum(total(k) for k in ['decode', 'load', 'transform', 'lowfft', 'transform2', 'collate'])
+        return 'I/O-bound' if io > cpu else 'decode-bound'
+
+    def report(self, epoch, log, dump=None):
+        summary = self.summary()
+        for stage, v in summary.items():
+            log_print('  {:<10s} n {:8d} total {:9.2f}s mean {:8.2f}ms p50 <{:8.2f}ms p99 <{:8.2f}ms'.format(
+                stage, v['count'], v['total'], v['mean'] * 1e3, v['p50'] * 1e3, v['p99'] * 1e3), log)
+        verdict = self.bottleneck(summary)
+        log_print('Epoch: [{}] input pipeline: {}'.format(epoch, verdict), log)
+        if dump is not None:
+            with open(dump, 'a') as f:
+                f.write(json.dumps({'epoch': epoch, 'verdict': verdict, 'stages': summary}) + '\n')
+        self.reset()
 
 
 def normt_spm(mx, method='in'):
+    import scipy.sparse as sp
     if method == 'in':
         mx = mx.transpose()
         rowsum = np.array(mx.sum(1))
@@ -40,6 +255,7 @@ def spm_to_tensor(sparse_mx):
 
 
 def adj_matrix(nc):
+    import scipy.sparse as sp
     adj = sp.coo_matrix((np.ones(nc), (range(nc), range(nc))), shape=(nc, nc), dtype='float32')
     adj = normt_spm(adj, method='in')
     adj = spm_to_tensor(adj)
@@ -80,7 +296,8 @@ def accuracy(output, target, topk=(1,)):
 
 def softmax(x):
     """Compute the softmax of vector x."""
-    exp_x = np.exp(x)
+    # shifting by the row max avoids overflow to inf/inf for large logits
+    exp_x = np.exp(x - np.max(x, axis=1, keepdims=True))
     softmax_x = exp_x / np.sum(exp_x, axis=1, keepdims=True)
     return softmax_x
 
@@ -144,7 +361,7 @@ def opt_domain_acc(cls_s, cls_t):
     return opt_acc_s, opt_acc_t, opt_tau
 
 
-def post_process(v_prob, a_prob,  gt, split_num, seen_c, unseen_c, data):
+def post_process(v_prob, a_prob,  gt, split_num, seen_c, unseen_c, data, bases=None):
     v_max = np.max(v_prob, axis=1)
     H_v = entropy(v_prob)
     v_pre = np.argmax(v_prob, axis=1)
@@ -159,11 +376,15 @@ def post_process(v_prob, a_prob,  gt, split_num, seen_c, unseen_c, data):
     opt_Ds = 0
     opt_Du = 0
     opt_tau = 0
+    opt_base = 0
 
-    for step in range(9):
-        base = 0.1 * step + 0.1
+    # ODR confidence thresholds to sweep, 0.1 ... 0.9 by default
+    if bases is None:
+        bases = [0.1 * step + 0.1 for step in range(9)]
+    for base in bases:
         tau = -base * np.log(base)
-        pre = v_pre
+        # relabel a fresh copy, the bases need not be ascending
+        pre = v_pre.copy()
         for idx, class_i in enumerate(pre):
             if (v_max[idx] - base < 0):
                 pre[idx] = a_pre[idx]
@@ -187,8 +408,60 @@ def post_process(v_prob, a_prob,  gt, split_num, seen_c, unseen_c, data):
             opt_Ds = Ds
             opt_Du = Du
             opt_tau = tau
-
-    return opt_H, opt_S, opt_U, opt_Ds, opt_Du, opt_tau
+            opt_base = base
+
+    # opt_base is the calibrated ODR confidence threshold used by gzsl_predict
+    return opt_H, opt_S, opt_U, opt_Ds, opt_Du, opt_tau, opt_base
+
+
+def gzsl_predict(v_prob, a_prob, base):
+    """GZSL decision of ``post_process`` for a calibrated threshold ``base``.
+
+    Samples whose ODR confidence ``max(v_prob)`` reaches ``base`` keep the ODR
+    (seen-class) prediction, the others take the ZSL prediction from ``a_prob``,
+    whose seen classes are masked out.
+
+    Returns:
+        tuple: (predicted class, True where the prediction came from the ODR head)
+    """
+    seen = np.max(v_prob, axis=1) >= base
+    return np.where(seen, np.argmax(v_prob, axis=1), np.argmax(a_prob, axis=1)), seen
+
+
+def gzsl_scores(odr_s, zsl_s, gt_s, odr_t, zsl_t, gt_t, seen_c, unseen_c, data, probs=False, bases=None):
+    """Evaluation of ``validate`` from the raw outputs on the seen (s) and unseen (t) test splits.
+
+    Args:
+        odr_s, zsl_s, odr_t, zsl_t (ndarray): ODR and ZSR logits, or class probabilities
+            when ``probs`` is set (flipping test averages softmax outputs).
+        gt_s, gt_t (ndarray): Labels.
+        bases (list, optional): ODR thresholds swept by ``post_process``.
+
+    Returns:
+        dict: SS, UU, ST, UT, H, CLS and the ``post_process`` optimum (H_opt, S_opt,
+        U_opt, Ds_opt, Du_opt, tau, base).
+    """
+    def split(odr, zsl, own_c, other_c):
+        zsl_own = zsl.copy()
+        zsl_own[:, other_c] = -1
+        zsl_unseen = zsl.copy()
+        zsl_unseen[:, seen_c] = -1
+        return (np.argmax(odr, axis=1), odr if probs else softmax(odr), np.argmax(zsl, axis=1),
+                np.argmax(zsl_own, axis=1), zsl_unseen if probs else softmax(zsl_unseen))
+
+    odr_pre_s, odr_prob_s, zsl_pre_sA, zsl_pre_sS, zsl_prob_s = split(odr_s, zsl_s, seen_c, unseen_c)
+    odr_pre_t, odr_prob_t, zsl_pre_tA, zsl_pre_tT, zsl_prob_t = split(odr_t, zsl_t, unseen_c, seen_c)
+    scores = collections.OrderedDict()
+    scores['SS'] = compute_class_accuracy_total(gt_s, zsl_pre_sS, seen_c)
+    scores['UU'] = compute_class_accuracy_total(gt_t, zsl_pre_tT, unseen_c)
+    scores['ST'] = compute_class_accuracy_total(gt_s, zsl_pre_sA, seen_c)
+    scores['UT'] = compute_class_accuracy_total(gt_t, zsl_pre_tA, unseen_c)
+    scores['H'] = 2 * scores['ST'] * scores['UT'] / (scores['ST'] + scores['UT'])
+    scores['CLS'] = compute_class_accuracy_total(gt_s, odr_pre_s, seen_c)
+    opt = post_process(np.vstack([odr_prob_s, odr_prob_t]), np.vstack([zsl_prob_s, zsl_prob_t]),
+                       np.hstack([gt_s, gt_t]), gt_s.shape[0], seen_c, unseen_c, data, bases)
+    scores.update(zip(['H_opt', 'S_opt', 'U_opt', 'Ds_opt', 'Du_opt', 'tau', 'base'], opt))
+    return scores
 
 
 class GaussianBlur(object):
@@ -274,7 +547,15 @@ class Randomswap(object):
 
 
 def preprocess_strategy(dataset, args):
+    # torchvision takes longer to import than torch itself, only pay for it when transforms are built
+    import torchvision.transforms as transforms
+    normalize = transforms.Normalize(mean=IMAGENET_MEAN, std=IMAGENET_STD)
     evaluate_transforms = None
+    if args.uint8_transport:
+        # workers emit uint8 CHW, normalization is done by Uint8Normalize on device
+        to_tensor = [transforms.PILToTensor()]
+    else:
+        to_tensor = [transforms.ToTensor(), normalize]
     if args.aug == "v1":
         train_transforms = transforms.Compose([
             transforms.RandomResizedCrop(448),
@@ -328,8 +609,7 @@ def preprocess_strategy(dataset, args):
         train_transforms2 = transforms.Compose([
             #transforms.RandomResizedCrop(448),
             #transforms.RandomHorizontalFlip(),
-            transforms.ToTensor(),
-            normalize,
+            *to_tensor,
         ])
 
     if args.flippingtest:
@@ -337,8 +617,7 @@ def preprocess_strategy(dataset, args):
             transforms.Resize(480),
             transforms.CenterCrop(448),
             transforms.Lambda(lambda x: [x, transforms.RandomHorizontalFlip(p=1.0)(x)]),
-            transforms.Lambda(lambda crops: [transforms.ToTensor()(crop) for crop in crops]),
-            transforms.Lambda(lambda crops: [normalize(crop) for crop in crops]),
+            transforms.Lambda(lambda crops: [transforms.Compose(to_tensor)(crop) for crop in crops]),
             transforms.Lambda(lambda crops: torch.stack(crops))
         ])
     else:
@@ -348,8 +627,7 @@ def preprocess_strategy(dataset, args):
     
         ])
         val_transforms2 = transforms.Compose([
-            transforms.ToTensor(),
-            normalize,
+            *to_tensor,
         ])
 
     return train_transforms,train_transforms2, val_transforms, val_transforms2
@@ -363,6 +641,21 @@ def save_checkpoint(state, filename='checkpoint.pth.tar'):
     torch.save(state, filename)
 
 
+def get_rng_state():
+    state = {'torch': torch.get_rng_state(), 'numpy': np.random.get_state(), 'python': random.getstate()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    torch.set_rng_state(state['torch'])
+    np.random.set_state(state['numpy'])
+    random.setstate(state['python'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
 def adjust_learning_rate(optimizer, optimizer1, optimizer2, epoch, args):
     """Sets the learning rate to the initial LR decayed by 10 every 30 epochs"""
     lr = args.lr1 * (0.1 ** (epoch // args.epoch_decay))
@@ -399,7 +692,41 @@ def freeze_bn(model):
             m.eval()
 
 
+def all_gather_arrays(*arrays):
+    """Concatenates NumPy arrays across all ranks, in rank order."""
+    gathered = [None] * dist.get_world_size()
+    dist.all_gather_object(gathered, arrays)
+    return [np.concatenate([g[i] for g in gathered]) for i in range(len(arrays))]
+
+
+def accumulate_gradients(model, criterion, input, target, att, steps):
+    """Forward and backward pass of a batch in ``steps`` micro-batches.
+
+    The loss terms are batch means, so weighting every micro-batch by its share of
+    the batch reproduces the full-batch gradient (with frozen BN). Under
+    DistributedDataParallel the gradients are all-reduced once, after the last
+    micro-batch.
+
+    Returns:
+        Tensor: L_odr, L_zsr, L_aux and L_fft of the whole batch.
+    """
+    losses = torch.zeros(4, device=input.device)
+    chunks = list(zip(input.chunk(steps), target.chunk(steps), att.chunk(steps)))
+    for k, (input_, target_, att_) in enumerate(chunks):
+        w = input_.size(0) / float(input.size(0))
+        last = k == len(chunks) - 1
+        with (model.no_sync() if not last and hasattr(model, 'no_sync') else contextlib.nullcontext()):
+            logits, feats = model(input_)
+            total_loss, L_odr, L_zsr, L_aux, L_fft = criterion(target_, logits, att_)
+            (total_loss * w).backward()
+        losses += torch.stack([L_odr, L_zsr, L_aux, L_fft]).detach() * w
+    return losses
+
+
 def log_print(s, log):
+    # non-zero ranks pass log=None and stay silent
+    if log is None:
+        return
     print(s)
     with open(log, 'a') as f:
         f.write(s + '\n')
\ No newline at end of file